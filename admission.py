@@ -0,0 +1,58 @@
+"""
+Admission control and load shedding for a worker
+
+Only requests that need a fetch go through the controller: answers that come
+from local state (cache, lists, invalid urls) are always given right away.
+With a FairQueue the limits apply to what a request's priority class is
+behind, so a bulk backlog does not get interactive requests shed.
+"""
+
+from httpget import fetches_in_flight, fetch_queue_wait
+
+
+OVERLOADED = 'overloaded'
+
+
+class AdmissionController(object):
+    """Decides whether a request may start a fetch
+    Args:
+        maxinflight - outstanding fetches per worker past which new fetches
+                      are refused (0 disables); with a FairQueue, those of
+                      the request's class and heavier ones
+        maxwait - average seconds fetches wait for a free client past which
+                  new fetches are refused (0 disables); with a FairQueue,
+                  the wait of the request's class for its turn counts too
+        retryafter - seconds shed clients are told to wait (Retry-After)
+    """
+    def __init__(self, maxinflight=480, maxwait=5, retryafter=5):
+        self.maxinflight = maxinflight
+        self.maxwait = maxwait
+        self.retryafter = retryafter
+        self.admitted = 0
+        self.shed = 0
+
+    def admit(self, fetch_queue=None, priority=None):
+        """True if a new fetch (of a priority class of fetch_queue) can be
+        started
+        """
+        in_flight, wait = fetches_in_flight(), fetch_queue_wait()
+        if fetch_queue is not None:
+            in_flight, class_wait = fetch_queue.load(priority)
+            wait = max(wait, class_wait)
+
+        if self.maxinflight and in_flight >= self.maxinflight:
+            self.shed += 1
+            return False
+
+        if self.maxwait and wait > self.maxwait:
+            self.shed += 1
+            return False
+
+        self.admitted += 1
+        return True
+
+    def stats(self):
+        return {'in_flight': fetches_in_flight(),
+                'queue_wait': fetch_queue_wait(),
+                'admitted': self.admitted,
+                'shed': self.shed}
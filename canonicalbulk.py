@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Bulk canonical url resolution from the command line
+
+Reads urls (one per line) from files or stdin, resolves them with the
+service's configuration and lists, and writes the results to stdout in input
+order, in any of the service's response formats.
+"""
+
+import sys
+import argparse
+import fileinput
+import logging
+from tornado.ioloop import IOLoop
+from canonicalservice import init_config, read_config_file, build_context
+from canonicalurl import get_canonical_url_async
+from canonicalformat import FORMATS, get_format
+
+
+class BulkResolver(object):
+    """Resolves urls with at most concurrency fetches at a time
+    Args:
+        resolve - resolve(url, handler), handler is called with the result
+        fmt - a canonicalformat format
+        out - file the results are written to
+    """
+    def __init__(self, resolve, fmt, out, concurrency=100):
+        self.resolve = resolve
+        self.fmt = fmt
+        self.out = out
+        self.concurrency = concurrency
+        self.urls = None
+        self.results = {}
+        self.started = 0
+        self.written = 0
+        self.active = 0
+        self.io_loop = None
+
+    def run(self, urls):
+        """Resolves all urls, returns the number of results written
+        """
+        self.urls = iter(urls)
+        self.io_loop = IOLoop.current()
+        self.out.write(self.fmt.header())
+        self.io_loop.add_callback(self.start_next)
+        self.io_loop.start()
+        self.out.write(self.fmt.footer())
+        self.out.flush()
+        return self.written
+
+    def start_next(self):
+        while self.urls is not None and self.active < self.concurrency:
+            try:
+                url = next(self.urls)
+            except StopIteration:
+                self.urls = None
+                break
+            self.active += 1
+            self.resolve(url, self.make_handler(self.started))
+            self.started += 1
+
+        if self.urls is None and not self.active:
+            self.io_loop.stop()
+
+    def make_handler(self, index):
+        def handler(result):
+            self.active -= 1
+            self.results[index] = result
+            self.write_ready()
+            # handlers may be called before resolve() returns
+            self.io_loop.add_callback(self.start_next)
+        return handler
+
+    def write_ready(self):
+        while self.written in self.results:
+            result = self.results.pop(self.written)
+            self.out.write(self.fmt.encode_item(result, self.written))
+            self.written += 1
+
+
+def read_urls(paths):
+    for line in fileinput.input(paths):
+        line = line.strip()
+        if line:
+            yield line
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Resolve canonical URLs.')
+    parser.add_argument('files', nargs='*', help='url files (default: stdin)')
+    parser.add_argument('--config', type=str, default=None,
+                        help='configuration file')
+    parser.add_argument('--format', type=str, default='ndjson',
+                        choices=[f.name for f in FORMATS],
+                        help='output format')
+    parser.add_argument('--concurrency', type=int, default=0,
+                        help='urls resolved at a time (default: maxclients)')
+    args = parser.parse_args()
+
+    config = init_config()
+    config = read_config_file(config, filepath=args.config)
+    logging.basicConfig(filename=config.get('service', 'log'), filemode='a',
+                        format="%(asctime)-15s %(process)d: %(message)s",
+                        level=config.getint('service', 'loglevel'))
+
+    ctx = build_context(config, service=False)
+
+    def resolve(url, handler):
+        get_canonical_url_async(url, ctx, handler)
+
+    resolver = BulkResolver(resolve, get_format(args.format), sys.stdout,
+                            args.concurrency or ctx.maxclients)
+    resolver.run(read_urls(args.files))
+
+
+if __name__ == '__main__':
+    main()
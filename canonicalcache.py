@@ -0,0 +1,92 @@
+"""
+Cache of resolved canonical URLs
+
+Each entry keeps the validators (ETag, Last-Modified) and the url of the
+response it was built from (the last hop of any redirects) so that, once
+expired, it can be revalidated with a conditional request instead of
+downloading and parsing the page again.
+"""
+
+import time
+from collections import OrderedDict
+
+
+CACHE_SIZE = 100000
+DEFAULT_TTL = 3600  # used when the origin does not say
+MAX_TTL = 86400
+
+
+class CanonicalCache(object):
+    """LRU cache of canonical url results keyed by normalized url
+    """
+    def __init__(self, size=CACHE_SIZE, ttl=DEFAULT_TTL, max_ttl=MAX_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.max_ttl = max_ttl
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, url):
+        """Returns the entry for url (fresh or not) or None
+        """
+        entry = self.entries.pop(url, None)
+        if entry is not None:
+            self.entries[url] = entry  # mark as most recently used
+        return entry
+
+    @staticmethod
+    def is_fresh(entry, now=None):
+        """True if the entry can be used without revalidation
+        """
+        if now is None:
+            now = time.time()
+        return entry['expires'] > now
+
+    def get_ttl(self, validators):
+        """Time to live from the origin's Cache-Control/Expires, if any
+        """
+        ttl = validators.get('max_age')
+        if ttl is None:
+            ttl = self.ttl
+        return max(0, min(ttl, self.max_ttl))
+
+    def put(self, url, result, validators):
+        """Stores a result along with the validators of its response
+        """
+        if validators is None or validators.get('no_store'):
+            self.entries.pop(url, None)
+            return
+
+        self.entries.pop(url, None)
+        self.entries[url] = {'result': result,
+                             'etag': validators.get('etag'),
+                             'last_modified': validators.get('last_modified'),
+                             'url': validators.get('url'),
+                             'expires': time.time() + self.get_ttl(validators)}
+
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def refresh(self, url, validators):
+        """Extends an entry after the origin answered 304 Not Modified
+        Returns the (updated) entry or None
+        """
+        entry = self.entries.get(url)
+        if entry is None:
+            return None
+
+        if validators is not None:
+            if validators.get('no_store'):
+                self.entries.pop(url, None)
+                return entry
+            if validators.get('etag'):
+                entry['etag'] = validators['etag']
+            if validators.get('last_modified'):
+                entry['last_modified'] = validators['last_modified']
+            if validators.get('url'):
+                entry['url'] = validators['url']
+            entry['expires'] = time.time() + self.get_ttl(validators)
+
+        return entry
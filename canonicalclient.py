@@ -1,60 +1,500 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+"""
+Client library of the canonical url service
 
-import argparse
+CanonicalClient is asynchronous (Tornado callbacks). resolve() calls made
+within batch_delay of each other are sent together to POST /batch in a
+compact format and their results are kept in a client side LRU cache.
+Batches are spread across the service endpoints (fewest outstanding batches
+first); shed urls and failed batches are retried with exponential backoff,
+honouring Retry-After. SyncCanonicalClient wraps it for blocking code.
+
+Run as a script to resolve urls, or with --load-test to measure a service.
+"""
+
+from __future__ import print_function
 import sys
-import json
 import time
-import requests
-import tornado.ioloop
-from tornado.httpclient import AsyncHTTPClient
-from tornado.httputil import url_concat
+import random
+import logging
+import argparse
+import fileinput
+from collections import Counter
+from tornado.ioloop import IOLoop
+from tornado.concurrent import Future
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from canonicalcache import CanonicalCache
+from canonicalformat import get_format, to_bytes
+try:
+    # keeps connections alive between batches, simple_httpclient does not
+    from tornado.curl_httpclient import CurlAsyncHTTPClient
+except ImportError:
+    CurlAsyncHTTPClient = None
+
+
+DEFAULT_ENDPOINT = 'http://localhost:7171'
+FORMAT = 'records'
+BATCH_SIZE = 100
+BATCH_DELAY = 0.005  # seconds resolve() calls are collected for a batch
+CACHE_SIZE = 10000
+CACHE_TTL = 3600
+RETRIES = 5
+BACKOFF = 0.1  # seconds before the first retry, doubles with each attempt
+MAX_BACKOFF = 30
+MAX_CLIENTS = 10
+TIMEOUT = 120  # a batch takes as long as its slowest url
+
+OVERLOADED = 'overloaded'
+SERVICE_UNAVAILABLE = 'service unavailable'
+INVALID_URL = 'invalid url'
+
+# results that do not depend on the service's load
+CACHEABLE = frozenset(['canonical', 'no attributes', 'not in lists',
+                       'not in whitelist', INVALID_URL])
+
+
+def make_http_client(max_clients, io_loop):
+    """Pooled HTTP client, with keep-alive connections if pycurl is installed
+    """
+    if CurlAsyncHTTPClient is not None:
+        return CurlAsyncHTTPClient(io_loop, max_clients=max_clients,
+                                   force_instance=True)
+    logging.warning('pycurl is not installed: every batch opens a new '
+                    'connection')
+    return AsyncHTTPClient(io_loop, max_clients=max_clients,
+                           force_instance=True)
+
+
+def get_retry_after(response):
+    """Seconds from the Retry-After header of a response, or None
+    """
+    value = response.headers.get('Retry-After') if response.headers else None
+    if value and value.strip().isdigit():
+        return int(value)
+    return None
+
+
+def unavailable(url):
+    return {'url_original': url,
+            'url_retrieved': None,
+            'method': None,
+            'reason': SERVICE_UNAVAILABLE}
+
+
+def invalid(url):
+    return {'url_original': url,
+            'url_retrieved': None,
+            'method': None,
+            'reason': INVALID_URL}
+
+
+def is_sendable(url):
+    """True if url makes exactly one url of a batch request
+    The service skips blank lines, a batch with a blank url (or one that
+    spans lines) would get a different number of results than urls and be
+    retried until every url in it is 'service unavailable'.
+    """
+    lines = (to_bytes(url) or b'').splitlines()
+    return len([line for line in lines if line.strip()]) == 1
+
+
+class Endpoint(object):
+    """A service instance and its state as seen by the client
+    """
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.in_flight = 0
+        self.batches = 0
+        self.failures = 0
+        self.retry_at = 0
+
+    def stats(self):
+        return {'in_flight': self.in_flight,
+                'batches': self.batches,
+                'failures': self.failures,
+                'retry_at': self.retry_at}
+
+
+class CanonicalClient(object):
+    """Asynchronous, batching client of one or more service endpoints
+    Args:
+        endpoints - service base urls, e.g. ['http://host:7171']
+        batch_size - most urls per batch (at most the service's maxbatch)
+        batch_delay - seconds resolve() calls are collected before sending
+        cache_size - results kept in the LRU cache (0 disables it)
+        cache_ttl - seconds results are kept
+        retries - attempts per url after the first
+        backoff - seconds before the first retry (doubles every attempt)
+        max_clients - concurrent batch requests
+        timeout - seconds per batch request
+        fmt - wire format name (see canonicalformat)
+
+    Urls that still fail after all retries get reason 'service unavailable'.
+    """
+    def __init__(self, endpoints, batch_size=BATCH_SIZE,
+                 batch_delay=BATCH_DELAY, cache_size=CACHE_SIZE,
+                 cache_ttl=CACHE_TTL, retries=RETRIES, backoff=BACKOFF,
+                 max_clients=MAX_CLIENTS, timeout=TIMEOUT, fmt=FORMAT,
+                 io_loop=None):
+        self.io_loop = io_loop or IOLoop.current()
+        self.endpoints = [Endpoint(url) for url in endpoints]
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.fmt = get_format(fmt)
+        self.cache = None
+        if cache_size:
+            self.cache = CanonicalCache(size=cache_size, ttl=cache_ttl,
+                                        max_ttl=cache_ttl)
+        self.http_client = make_http_client(max_clients, self.io_loop)
+        self.callbacks = {}  # url -> callbacks, for every unanswered url
+        self.attempts = Counter()
+        self.queue = []
+        self.timer = None
+        self.next_endpoint = 0
+        self.counters = Counter()
+
+    def resolve(self, url, callback):
+        """Calls callback(result) with the service's result for url
+        """
+        self.counters['requests'] += 1
+        if not is_sendable(url):
+            self.counters['invalid'] += 1
+            self.io_loop.add_callback(callback, invalid(url))
+            return
+
+        if self.cache is not None:
+            entry = self.cache.get(url)
+            if entry is not None and self.cache.is_fresh(entry):
+                self.counters['cache_hits'] += 1
+                self.io_loop.add_callback(callback, entry['result'])
+                return
+
+        # the same url is only asked once at a time
+        if url in self.callbacks:
+            self.counters['coalesced'] += 1
+            self.callbacks[url].append(callback)
+            return
+
+        self.callbacks[url] = [callback]
+        self.enqueue([url])
 
+    def resolve_many(self, urls, callback):
+        """Calls callback(results) with the results in the order of urls
+        """
+        results = [None] * len(urls)
+        remaining = [len(urls)]
+        if not urls:
+            self.io_loop.add_callback(callback, results)
+            return
 
-testurls = ['https://t.co/gFVKpELNO0',
-            'https://docs.python.org/2/library/configparser.html',
-            'http://www.huffingtonpost.com/entry/clinton-sanders-debate_us_56bd67d2e4b0b40245c60e1f',
-            'http://edition.cnn.com/2016/02/11/entertainment/taylor-swift-kanye-west-new-song/index.html',
-            'http://www.nytimes.com/2016/02/11/technology/twitter-to-save-itself-must-scale-back-world-swallowing-ambitions.html?ref=technology',
-            'http://blogs.sciencemag.org/pipeline/archives/2012/07/31/synthetic_chemistry_the_rise_of_the_algorithms',
-            'http://bbc.in/1Xlrix7',
-            'https://t.co/MefZPI6SNw',
-        ]
+        def make_handler(index):
+            def handler(result):
+                results[index] = result
+                remaining[0] -= 1
+                if not remaining[0]:
+                    callback(results)
+            return handler
 
+        for index, url in enumerate(urls):
+            self.resolve(url, make_handler(index))
 
-def handle_request(response):
-    if response.error:
-        print "Error:", response.error
-    else:
-        print type(response.body)
-        print(json.loads(response.body))
+    def enqueue(self, urls):
+        self.queue.extend(urls)
+        if len(self.queue) >= self.batch_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = self.io_loop.call_later(self.batch_delay, self.flush)
 
+    def flush(self):
+        """Sends the queued urls, batch_size at a time
+        """
+        if self.timer is not None:
+            self.io_loop.remove_timeout(self.timer)
+            self.timer = None
 
-def async_client(address):
-    http_client = AsyncHTTPClient()
+        while self.queue:
+            endpoint = self.pick_endpoint()
+            if endpoint is None:
+                # every endpoint is backing off: wait for the first one
+                wait = min(e.retry_at for e in self.endpoints) - time.time()
+                self.timer = self.io_loop.call_later(
+                    max(wait, self.batch_delay), self.flush)
+                return
+            urls = self.queue[:self.batch_size]
+            del self.queue[:self.batch_size]
+            self.send(endpoint, urls)
 
-    for testurl in testurls:
-        params = {"url": testurl}
-        url = url_concat(address, params)
-        print(url)
-        http_client.fetch(url, handle_request)
+    def pick_endpoint(self):
+        """Endpoint with the fewest outstanding batches, None if all back off
+        Ties go round robin.
+        """
+        now = time.time()
+        count = len(self.endpoints)
+        best = None
+        for i in xrange(count):
+            endpoint = self.endpoints[(self.next_endpoint + i) % count]
+            if endpoint.retry_at > now:
+                continue
+            if best is None or endpoint.in_flight < best.in_flight:
+                best = endpoint
+        self.next_endpoint = (self.next_endpoint + 1) % count
+        return best
 
-    tornado.ioloop.IOLoop.instance().start()
+    def send(self, endpoint, urls):
+        body = b'\n'.join(to_bytes(url) for url in urls)
+        request = HTTPRequest(endpoint.url + '/batch?format=' + self.fmt.name,
+                              method='POST', body=body,
+                              headers={'Accept': self.fmt.content_type},
+                              request_timeout=self.timeout)
+        endpoint.in_flight += 1
+        endpoint.batches += 1
+        self.counters['batches'] += 1
+        self.http_client.fetch(request,
+                               self.make_response_handler(endpoint, urls))
 
+    def make_response_handler(self, endpoint, urls):
+        def handle_response(response):
+            endpoint.in_flight -= 1
+            results = None
+            if response.code == 200:
+                try:
+                    results = self.fmt.decode(response.body)
+                except Exception as ex:
+                    logging.exception(ex)
 
-def sync_client(address):
-    for testurl in testurls:
-        params = {"url": testurl}
-        r = requests.get(address, params=params)
-        print(r.json())
+            if results is not None and len(results) == len(urls):
+                endpoint.failures = 0
+                shed = []
+                for url, result in zip(urls, results):
+                    if result.get('reason') == OVERLOADED:
+                        shed.append(url)
+                    else:
+                        self.done(url, result)
+                if shed:
+                    self.retry(shed)
+                return
+
+            logging.warning('batch to %s failed: %s %s', endpoint.url,
+                            response.code, response.error)
+            endpoint.failures += 1
+            self.counters['failed_batches'] += 1
+            if 400 <= response.code < 500:
+                # the request itself is wrong, sending it again will not help
+                for url in urls:
+                    self.done(url, unavailable(url))
+                return
+
+            # unavailable, overloaded or broken: give the endpoint a rest
+            retry_after = get_retry_after(response)
+            endpoint.retry_at = time.time() + (
+                retry_after or self.get_backoff(endpoint.failures))
+            self.retry(urls, retry_after)
+        return handle_response
+
+    def get_backoff(self, attempt):
+        """Exponential backoff with jitter
+        """
+        delay = min(self.backoff * 2 ** (attempt - 1), MAX_BACKOFF)
+        return delay * random.uniform(0.5, 1.5)
+
+    def retry(self, urls, retry_after=None):
+        """Sends urls again after a backoff, gives up on those out of retries
+        """
+        again = []
+        attempt = 0
+        for url in urls:
+            self.attempts[url] += 1
+            if self.attempts[url] > self.retries:
+                self.done(url, unavailable(url))
+                continue
+            attempt = max(attempt, self.attempts[url])
+            again.append(url)
+
+        if not again:
+            return
+        self.counters['retries'] += len(again)
+        delay = retry_after or self.get_backoff(attempt)
+        self.io_loop.call_later(delay, self.enqueue, again)
+
+    def done(self, url, result):
+        self.attempts.pop(url, None)
+        if self.cache is not None and result.get('reason') in CACHEABLE:
+            self.cache.put(url, result, {})
+        if result.get('reason') == SERVICE_UNAVAILABLE:
+            self.counters['unavailable'] += 1
+        for callback in self.callbacks.pop(url, []):
+            try:
+                callback(result)
+            except Exception as ex:
+                logging.exception(ex)
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats['endpoints'] = dict((e.url, e.stats()) for e in self.endpoints)
+        stats['waiting'] = len(self.callbacks)
+        if self.cache is not None:
+            stats['cache'] = len(self.cache)
+        return stats
+
+    def close(self):
+        if self.timer is not None:
+            self.io_loop.remove_timeout(self.timer)
+            self.timer = None
+        self.http_client.close()
+
+
+class SyncCanonicalClient(object):
+    """Blocking CanonicalClient, runs its own IOLoop
+    Takes the same arguments as CanonicalClient.
+    """
+    def __init__(self, endpoints, **kwargs):
+        self.io_loop = IOLoop(make_current=False)
+        self.client = CanonicalClient(endpoints, io_loop=self.io_loop,
+                                      **kwargs)
+
+    def resolve(self, url):
+        return self.resolve_many([url])[0]
+
+    def resolve_many(self, urls):
+        """Results in the order of urls
+        """
+        def run():
+            future = Future()
+            self.client.resolve_many(urls, future.set_result)
+            return future
+        return self.io_loop.run_sync(run)
+
+    def stats(self):
+        return self.client.stats()
+
+    def close(self):
+        self.client.close()
+        self.io_loop.close()
+
+
+class LoadTest(object):
+    """Resolves count urls with concurrency of them outstanding at a time
+    Urls are taken from urls in turn; unique makes each one distinct (with a
+    query argument) so that no cache answers them.
+    """
+    def __init__(self, client, urls, count, concurrency=100, unique=False):
+        self.client = client
+        self.urls = urls
+        self.count = count
+        self.concurrency = concurrency
+        self.unique = unique
+        self.started = 0
+        self.finished = 0
+        self.latencies = []
+        self.reasons = Counter()
+        self.start_time = None
+
+    def run(self):
+        """Runs on the client's IOLoop, returns the report
+        """
+        self.start_time = time.time()
+        self.client.io_loop.add_callback(self.start_next)
+        self.client.io_loop.start()
+        return self.report(time.time() - self.start_time)
+
+    def start_next(self):
+        while (self.started < self.count and
+               self.started - self.finished < self.concurrency):
+            url = self.urls[self.started % len(self.urls)]
+            if self.unique:
+                sep = '&' if '?' in url else '?'
+                url = '{}{}loadtest={}'.format(url, sep, self.started)
+            self.client.resolve(url, self.make_handler(time.time()))
+            self.started += 1
+
+    def make_handler(self, started):
+        def handler(result):
+            self.latencies.append(time.time() - started)
+            self.reasons[result.get('reason')] += 1
+            self.finished += 1
+            if self.finished == self.count:
+                self.client.io_loop.stop()
+            else:
+                self.start_next()
+        return handler
+
+    def report(self, elapsed):
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1,
+                                 int(p * len(latencies)))]
+
+        return {'requests': self.finished,
+                'elapsed': elapsed,
+                'rate': self.finished / elapsed if elapsed else None,
+                'latency': {'p50': percentile(0.5),
+                            'p90': percentile(0.9),
+                            'p99': percentile(0.99),
+                            'max': latencies[-1] if latencies else None},
+                'reasons': dict(self.reasons),
+                'client': self.client.stats()}
+
+
+def read_urls(paths):
+    for line in fileinput.input(paths):
+        line = line.strip()
+        if line:
+            yield line
 
 
 def main():
-    port = sys.argv[1]
-    address = 'http://localhost:' + port
+    parser = argparse.ArgumentParser(description='Canonical URL client.')
+    parser.add_argument('urls', nargs='*',
+                        help='urls to resolve (default: read from --input)')
+    parser.add_argument('--input', type=str, action='append', default=[],
+                        help='file with one url per line (default: stdin)')
+    parser.add_argument('--endpoint', type=str, action='append', default=[],
+                        help='service url, may be repeated '
+                             '(default: ' + DEFAULT_ENDPOINT + ')')
+    parser.add_argument('--format', type=str, default=FORMAT,
+                        help='wire format')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--batch-delay', type=float, default=BATCH_DELAY)
+    parser.add_argument('--cache-size', type=int, default=CACHE_SIZE)
+    parser.add_argument('--max-clients', type=int, default=MAX_CLIENTS)
+    parser.add_argument('--load-test', type=int, default=0, metavar='N',
+                        help='resolve N urls and report throughput/latency')
+    parser.add_argument('--concurrency', type=int, default=100,
+                        help='outstanding urls during the load test')
+    parser.add_argument('--unique', action='store_true',
+                        help='load test: make every url distinct')
+    args = parser.parse_args()
+
+    urls = args.urls or list(read_urls(args.input))
+    options = {'batch_size': args.batch_size,
+               'batch_delay': args.batch_delay,
+               'cache_size': args.cache_size,
+               'max_clients': args.max_clients,
+               'fmt': args.format}
+    endpoints = args.endpoint or [DEFAULT_ENDPOINT]
+    ndjson = get_format('ndjson')
+
+    if args.load_test:
+        client = CanonicalClient(endpoints, io_loop=IOLoop.current(),
+                                 **options)
+        report = LoadTest(client, urls, args.load_test, args.concurrency,
+                          args.unique).run()
+        client.close()
+        sys.stdout.write(ndjson.encode(report))
+        return
+
+    client = SyncCanonicalClient(endpoints, **options)
+    for result in client.resolve_many(urls):
+        sys.stdout.write(ndjson.encode(result))
+    client.close()
+
 
-    sync_client(address)
-    #async_client(address)
-    
 if __name__ == '__main__':
     main()
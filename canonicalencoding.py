@@ -71,7 +71,7 @@ def try_encoding(page, encoding):
     '''Tries to decode a page using an encoding (strict - no errors)
     '''
     try:
-        ucontent = unicode(page, encoding, 'strict')
+        ucontent = page.decode(encoding, 'strict')
         return ucontent
     except:
         return None
@@ -81,7 +81,7 @@ def try_encoding_force(page, encoding):
     '''Tries to decode a page using an encoding (replace errors)
     '''
     try:
-        ucontent = unicode(html, encoding, 'replace')
+        ucontent = page.decode(encoding, 'replace')
         return ucontent
     except:
         return None
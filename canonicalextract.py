@@ -3,10 +3,17 @@ Handles processing of a downloaded web page
 """
 
 
+import time
 import logging
 from bs4 import BeautifulSoup, UnicodeDammit, FeatureNotFound
 from canonicalencoding import try_encoding
 from urlhelpers import url_or_error
+from pagecache import content_key
+
+
+# bump whenever decoding or extraction changes what a page yields: page
+# feature cache tables written by another version are cleared
+EXTRACT_VERSION = 1
 
 
 def decode_web_page(html, enc):
@@ -32,7 +39,10 @@ def decode_web_page(html, enc):
 
     # if we fail, resort to UnicodeDammit
     # because we have cchardet installed, this will try to use it
+    # (it only accepts str, so bodies kept as bytearray are copied here)
     try:
+        if not isinstance(html, str):
+            html = bytes(html)
         ucontent = UnicodeDammit(html, is_html=True).unicode_markup
 
         return ucontent
@@ -84,8 +94,12 @@ def extract_canonical(unicode_content):
     return None
 
 
-def process_page(page, enc, url, ret_url, method):
+def process_page(page, enc, url, ret_url, method, timings=None,
+                 features=None):
     """Checks if page exists, if it can be decoded and if url can be extracted
+    If a timings dict is given, decode_time and extract_time are set in it.
+    If a PageFeatureCache is given, pages with the same content as one seen
+    before are not decoded and parsed again.
     """
     # check if page was downloaded
     if page is None:
@@ -95,25 +109,56 @@ def process_page(page, enc, url, ret_url, method):
                 'method': method,
                 'reason': 'no content'}
 
+    # same bytes, same result
+    key = None
+    if features is not None and page:
+        started = time.time()
+        key = content_key(page, enc)
+        cached = features.get(key, ret_url)
+        if timings is not None:
+            timings['hash_time'] = time.time() - started
+            timings['page_cache'] = 'miss' if cached is None else 'hit'
+        if cached is not None:
+            reason, canonical = cached
+            if reason == 'canonical':
+                ret_url = canonical
+                method = 'canonical'
+            return {'url_original': url,
+                    'url_retrieved': ret_url,
+                    'method': method,
+                    'reason': reason}
+
     # check for decoding errors
+    started = time.time()
     page = decode_web_page(page, enc)
+    if timings is not None:
+        timings['decode_time'] = time.time() - started
     if page is None:
         # could not decode
+        if key is not None:
+            features.put(key, 'decode failed')
         return {'url_original': url,
                 'url_retrieved': ret_url,
                 'method': method,
                 'reason': 'decode failed'}
 
     # attempt to extract canonical/og url from content
+    started = time.time()
     canonical = extract_canonical(page)
+    if timings is not None:
+        timings['extract_time'] = time.time() - started
     if canonical is None:
         # couldnt extract canonical/og url
+        if key is not None:
+            features.put(key, 'no attributes')
         return {'url_original': url,
                 'url_retrieved': ret_url,
                 'method': method,
                 'reason': 'no attributes'}
 
     # we got it!!!
+    if key is not None:
+        features.put(key, 'canonical', canonical)
     ret_url = canonical
     method = 'canonical'
 
@@ -0,0 +1,260 @@
+"""
+Serialization of canonical url results
+
+Formats:
+    json - a JSON object (a list of them for batches)
+    ndjson - one JSON object per line, for streams
+    records - compact length-prefixed binary records
+    msgpack - msgpack arrays (if the msgpack module is installed)
+
+The binary formats replace the method and reason strings by the codes in
+METHODS and REASONS. Used by the service endpoints and the bulk command
+line tool alike.
+"""
+
+import json
+import time
+import struct
+import random
+import argparse
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# index in the list is the code, 0 is used for anything unknown
+METHODS = [None, 'original', 'redirect', 'canonical', 'bad url']
+REASONS = [None, 'canonical', 'no attributes', 'not in lists',
+           'not in whitelist', 'invalid url', 'unreachable', 'no content',
+           'decode failed', 'overloaded']
+METHOD_CODES = dict((m, i) for i, m in enumerate(METHODS))
+REASON_CODES = dict((r, i) for i, r in enumerate(REASONS))
+
+# method code, reason code, url_original length, url_retrieved length
+RECORD = struct.Struct('>BBII')
+NO_URL = 0xffffffff
+
+
+def to_codes(result):
+    """(method code, reason code, url_original, url_retrieved) of a result
+    """
+    return (METHOD_CODES.get(result.get('method'), 0),
+            REASON_CODES.get(result.get('reason'), 0),
+            result.get('url_original'),
+            result.get('url_retrieved'))
+
+
+def from_codes(method, reason, url_original, url_retrieved):
+    return {'url_original': url_original,
+            'url_retrieved': url_retrieved,
+            'method': METHODS[method] if method < len(METHODS) else None,
+            'reason': REASONS[reason] if reason < len(REASONS) else None}
+
+
+def to_bytes(url):
+    if url is None:
+        return None
+    if isinstance(url, unicode):
+        return url.encode('utf8')
+    return url
+
+
+def from_bytes(url):
+    if url is None:
+        return None
+    return url.decode('utf8', 'replace')
+
+
+class JSONFormat(object):
+    """JSON object, or a JSON list of objects for batches
+    """
+    name = 'json'
+    content_type = 'application/json; charset=UTF-8'
+
+    def encode(self, result):
+        return json.dumps(result)
+
+    def header(self):
+        return '['
+
+    def encode_item(self, result, index):
+        return (',' if index else '') + json.dumps(result)
+
+    def footer(self):
+        return ']'
+
+    def decode(self, data):
+        data = json.loads(data)
+        return data if isinstance(data, list) else [data]
+
+
+class NDJSONFormat(JSONFormat):
+    """One JSON object per line
+    """
+    name = 'ndjson'
+    content_type = 'application/x-ndjson'
+
+    def encode(self, result):
+        return json.dumps(result, separators=(',', ':')) + '\n'
+
+    def header(self):
+        return ''
+
+    def encode_item(self, result, index):
+        return self.encode(result)
+
+    def footer(self):
+        return ''
+
+    def decode(self, data):
+        return [json.loads(line) for line in data.splitlines() if line]
+
+
+class RecordsFormat(object):
+    """Length-prefixed binary records, no dependencies
+    Each record is a RECORD header followed by the utf8 urls; a length of
+    NO_URL means None.
+    """
+    name = 'records'
+    content_type = 'application/vnd.canonical.records'
+
+    def encode(self, result):
+        method, reason, original, retrieved = to_codes(result)
+        original = to_bytes(original)
+        retrieved = to_bytes(retrieved)
+        return b''.join([
+            RECORD.pack(method, reason,
+                        NO_URL if original is None else len(original),
+                        NO_URL if retrieved is None else len(retrieved)),
+            original or b'', retrieved or b''])
+
+    def header(self):
+        return b''
+
+    def encode_item(self, result, index):
+        return self.encode(result)
+
+    def footer(self):
+        return b''
+
+    def decode(self, data):
+        results = []
+        unpack_from = RECORD.unpack_from
+        size = RECORD.size
+        offset = 0
+        end = len(data)
+        while offset < end:
+            method, reason, olen, rlen = unpack_from(data, offset)
+            offset += size
+            original = retrieved = None
+            if olen != NO_URL:
+                original = data[offset:offset + olen].decode('utf8', 'replace')
+                offset += olen
+            if rlen != NO_URL:
+                retrieved = data[offset:offset + rlen].decode('utf8',
+                                                              'replace')
+                offset += rlen
+            results.append(from_codes(method, reason, original, retrieved))
+        return results
+
+
+class MsgpackFormat(RecordsFormat):
+    """msgpack arrays [method code, reason code, url_original, url_retrieved]
+    """
+    name = 'msgpack'
+    content_type = 'application/x-msgpack'
+
+    def encode(self, result):
+        method, reason, original, retrieved = to_codes(result)
+        return msgpack.packb([method, reason, to_bytes(original),
+                              to_bytes(retrieved)])
+
+    def decode(self, data):
+        unpacker = msgpack.Unpacker()
+        unpacker.feed(data)
+        return [from_codes(m, r, from_bytes(o), from_bytes(u))
+                for m, r, o, u in unpacker]
+
+
+FORMATS = [JSONFormat(), NDJSONFormat(), RecordsFormat()]
+if msgpack is not None:
+    FORMATS.append(MsgpackFormat())
+BY_NAME = dict((f.name, f) for f in FORMATS)
+BY_TYPE = dict((f.content_type.split(';')[0], f) for f in FORMATS)
+DEFAULT_FORMAT = BY_NAME['json']
+
+
+def get_format(name):
+    """Format by name, raises KeyError if unknown or unavailable
+    """
+    return BY_NAME[name]
+
+
+def negotiate(name=None, accept=None):
+    """Picks a format from an explicit name or an Accept header
+    Returns None if an explicitly requested format is not available.
+    """
+    if name:
+        return BY_NAME.get(name)
+
+    if accept:
+        for part in accept.split(','):
+            media_type = part.split(';')[0].strip().lower()
+            if media_type in BY_TYPE:
+                return BY_TYPE[media_type]
+
+    return DEFAULT_FORMAT
+
+
+def synthetic_results(count, seed=0):
+    """Results that look like the service's
+    """
+    rand = random.Random(seed)
+    results = []
+    for i in xrange(count):
+        original = u'http://news{}.example.com/2016/02/{}/article-{}.html'
+        original = original.format(i % 1000, i % 28, i)
+        reason = rand.choice(REASONS[1:])
+        method = 'canonical' if reason == 'canonical' else 'original'
+        results.append({'url_original': original,
+                        'url_retrieved': original.replace('news', 'www'),
+                        'method': method,
+                        'reason': reason})
+    return results
+
+
+def benchmark(count):
+    """Compares sizes and encode/decode rates of the formats
+    """
+    results = synthetic_results(count)
+    for fmt in FORMATS:
+        started = time.time()
+        parts = [fmt.header()]
+        for index, result in enumerate(results):
+            parts.append(fmt.encode_item(result, index))
+        parts.append(fmt.footer())
+        data = b''.join(parts)
+        encoded = time.time() - started
+
+        started = time.time()
+        decoded = fmt.decode(data)
+        elapsed = time.time() - started
+        assert len(decoded) == count
+
+        print('{:8} {:10d} bytes {:7.1f} B/result  encode {:9.0f}/s  '
+              'decode {:9.0f}/s'.format(fmt.name, len(data),
+                                        float(len(data)) / count,
+                                        count / encoded, count / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Result format benchmark.')
+    parser.add_argument('--count', type=int, default=100000,
+                        help='number of results')
+    args = parser.parse_args()
+    benchmark(args.count)
+
+
+if __name__ == '__main__':
+    main()
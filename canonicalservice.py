@@ -12,7 +12,19 @@ import argparse
 import logging
 import ConfigParser
 from domainlists import load_list, get_extractor
-from server import serve
+from canonicalcache import CanonicalCache
+from refreshahead import RefreshAhead
+from admission import AdmissionController
+from requestlog import RequestLog
+from crawltrace import TraceRecorder
+from fetchbudget import SharedFetchBudget
+from server import serve, serve_worker
+from supervisor import Supervisor
+from profiling import SlowRequests
+from pagecache import PageFeatureCache
+from canonicalextract import EXTRACT_VERSION
+from fairqueue import FairQueue, parse_pairs
+from servicecontext import ServiceContext
 
 
 DEFAULT_PORT = 7171
@@ -32,7 +44,10 @@ def init_config():
 
     # logging
     config.set('service', 'log', '/tmp/canonical.log')
-    config.set('service', 'loglevel', logging.DEBUG)
+    config.set('service', 'loglevel', logging.INFO)
+
+    # most urls in one POST /batch
+    config.set('service', 'maxbatch', 1000)
 
     # Lists
     config.add_section('lists')
@@ -46,7 +61,95 @@ def init_config():
     config.set('canonical', 'timeout', 30)
     config.set('canonical', 'maxsize', 2097152)
     config.set('canonical', 'maxclients', 100)
-    config.set('canonical', 'tldcache', './cache.tld')
+    # compiled public suffix table, empty for the bundled snapshot
+    config.set('canonical', 'suffixes', '')
+    config.set('canonical', 'privatesuffixes', 'no')
+
+    # Result cache (ttl is only used when the origin sends no Cache-Control)
+    config.add_section('cache')
+
+    config.set('cache', 'size', 100000)
+    config.set('cache', 'ttl', 3600)
+    config.set('cache', 'maxttl', 86400)
+
+    # Extraction results by page content, shared by all workers
+    # (in memory only when path is empty; a file is locked via path.lock
+    # and may be shared with canonicalbulk)
+    config.add_section('pagecache')
+
+    config.set('pagecache', 'enabled', 'yes')
+    config.set('pagecache', 'path', '')
+    config.set('pagecache', 'slots', 16384)
+
+    # Weighted fair queuing of fetches between priority classes and callers
+    # (keys maps API keys to classes, e.g. "secret1:interactive, secret2:bulk")
+    config.add_section('priority')
+
+    config.set('priority', 'enabled', 'yes')
+    config.set('priority', 'classes', 'interactive:8, normal:4, bulk:1')
+    config.set('priority', 'default', 'normal')
+    config.set('priority', 'header', 'X-Priority')
+    config.set('priority', 'keyheader', 'X-API-Key')
+    config.set('priority', 'keys', '')
+    config.set('priority', 'quota', 50)
+
+    # Refresh-ahead of hot cache entries
+    config.add_section('refresh')
+
+    config.set('refresh', 'enabled', 'yes')
+    config.set('refresh', 'threshold', 10)
+    config.set('refresh', 'window', 60)
+    config.set('refresh', 'spare', 0.5)
+    config.set('refresh', 'interval', 500)
+    config.set('refresh', 'decay', 300)
+
+    # Load shedding of requests that need a fetch (0 disables a threshold)
+    config.add_section('admission')
+
+    config.set('admission', 'maxinflight', 480)
+    config.set('admission', 'maxwait', 5)
+    config.set('admission', 'retryafter', 5)
+
+    # JSON request log, one file per worker, successes are sampled
+    config.add_section('requestlog')
+
+    config.set('requestlog', 'enabled', 'yes')
+    config.set('requestlog', 'path', '/tmp/canonical-requests.{worker}.log')
+    config.set('requestlog', 'sample', 0.1)
+
+    # Crawl trace recording (WARC archive of every fetched hop, one file per
+    # worker) for offline replay with crawltrace.py
+    config.add_section('recording')
+
+    config.set('recording', 'enabled', 'no')
+    config.set('recording', 'path', '/tmp/canonical-trace.{worker}.warc.gz')
+    config.set('recording', 'sample', 1.0)
+
+    # Outbound fetch limits shared by all workers (0 disables a limit)
+    config.add_section('budget')
+
+    config.set('budget', 'enabled', 'yes')
+    config.set('budget', 'maxclients', 100)
+    config.set('budget', 'perhost', 16)
+    config.set('budget', 'rate', 0)
+    config.set('budget', 'hostrate', 0)
+
+    # Supervisor mode: SO_REUSEPORT workers with graceful rolling restarts
+    config.add_section('workers')
+
+    config.set('workers', 'supervisor', 'no')
+    config.set('workers', 'count', 0)
+    config.set('workers', 'pin', 'no')
+    config.set('workers', 'drain', 30)
+
+    # Debug endpoints: /debug/slow, /debug/profile (sampling profiler) and
+    # /stats of each worker, on 127.0.0.1 port adminport + worker index
+    config.add_section('debug')
+
+    config.set('debug', 'enabled', 'no')
+    config.set('debug', 'adminport', 7271)
+    config.set('debug', 'slowthreshold', 2.0)
+    config.set('debug', 'slowsize', 100)
 
     # return
     return config
@@ -93,15 +196,23 @@ def read_config_file(config, filepath=None):
 
 def setup_logging(config):
     """Sets up logging
+    Returns the RequestLog or None; its writer threads are started in each
+    worker after forking.
     """
     format_str = "%(asctime)-15s %(process)d: %(message)s"
     logpath = config.get('service', 'log')
     loglevel = config.getint('service', 'loglevel')
 
-    # General logging
-    logging.basicConfig(filename=logpath, filemode='w',
+    # General logging (appended to: the file is shared by all workers)
+    logging.basicConfig(filename=logpath, filemode='a',
                         format=format_str, level=loglevel)
 
+    if not config.getboolean('requestlog', 'enabled'):
+        return None
+
+    return RequestLog(config.get('requestlog', 'path'),
+                      sample=config.getfloat('requestlog', 'sample'))
+
 
 def load_lists(config):
     """Returns Whitelist, Shortner List
@@ -127,6 +238,83 @@ def load_lists(config):
     return whitelist, shorteners
 
 
+def build_context(config, request_log=None, caches=True, service=True,
+                  http_client=None):
+    """ServiceContext of a configuration
+    The services workers share (page cache, fetch budget) are created here:
+    call it before forking. caches=False leaves out the result and page
+    caches, service=False what only the service runs (refresh-ahead,
+    admission control, fetch budget, priority classes, recording and debug
+    capture).
+    """
+    whitelist, shorteners = load_lists(config)
+    extract = get_extractor(config.get('canonical', 'suffixes'),
+                            config.getboolean('canonical', 'privatesuffixes'))
+    maxclients = config.getint('canonical', 'maxclients')
+    ctx = ServiceContext(whitelist, shorteners, extract,
+                         timeout=config.getint('canonical', 'timeout'),
+                         maxsize=config.getint('canonical', 'maxsize'),
+                         maxclients=maxclients,
+                         maxbatch=config.getint('service', 'maxbatch'),
+                         adminport=config.getint('debug', 'adminport'),
+                         request_log=request_log, http_client=http_client)
+
+    if caches:
+        ctx.cache = CanonicalCache(size=config.getint('cache', 'size'),
+                                   ttl=config.getint('cache', 'ttl'),
+                                   max_ttl=config.getint('cache', 'maxttl'))
+        if config.getboolean('pagecache', 'enabled'):
+            ctx.features = PageFeatureCache(
+                slots=config.getint('pagecache', 'slots'),
+                path=config.get('pagecache', 'path') or None,
+                version=EXTRACT_VERSION)
+
+    if not service:
+        return ctx
+
+    if config.getboolean('refresh', 'enabled'):
+        ctx.refresher = RefreshAhead(
+            threshold=config.getint('refresh', 'threshold'),
+            window=config.getint('refresh', 'window'),
+            spare=config.getfloat('refresh', 'spare'),
+            interval=config.getint('refresh', 'interval'),
+            decay=config.getint('refresh', 'decay'))
+    ctx.admission = AdmissionController(
+        maxinflight=config.getint('admission', 'maxinflight'),
+        maxwait=config.getfloat('admission', 'maxwait'),
+        retryafter=config.getint('admission', 'retryafter'))
+
+    if config.getboolean('debug', 'enabled'):
+        ctx.slow = SlowRequests(
+            threshold=config.getfloat('debug', 'slowthreshold'),
+            size=config.getint('debug', 'slowsize'))
+
+    if config.getboolean('budget', 'enabled'):
+        ctx.budget = SharedFetchBudget(
+            maxclients=config.getint('budget', 'maxclients'),
+            perhost=config.getint('budget', 'perhost'),
+            rate=config.getfloat('budget', 'rate'),
+            hostrate=config.getfloat('budget', 'hostrate'))
+
+    if config.getboolean('priority', 'enabled'):
+        ctx.fetch_queue = FairQueue(
+            maxclients,
+            classes=parse_pairs(config.get('priority', 'classes'), float),
+            default=config.get('priority', 'default'),
+            quota=config.getint('priority', 'quota'),
+            keys=parse_pairs(config.get('priority', 'keys')),
+            header=config.get('priority', 'header'),
+            keyheader=config.get('priority', 'keyheader'),
+            budget=ctx.budget)
+
+    if config.getboolean('recording', 'enabled'):
+        ctx.recorder = TraceRecorder(
+            config.get('recording', 'path'),
+            sample=config.getfloat('recording', 'sample'))
+
+    return ctx
+
+
 def save_config(config, filepath):
     """Saves the current configuration to a file
     """
@@ -150,6 +338,9 @@ def main():
                         help='URL shorteners file')
     parser.add_argument('--save-config', type=str, default=None,
                         help='Export configuration to this file')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='run supervised SO_REUSEPORT workers '
+                             '(0 = one per CPU)')
 
     # Parse
     args = parser.parse_args()
@@ -165,25 +356,37 @@ def main():
         config.set('lists', 'whitelist', args.whitelist)
     if args.shorteners:
         config.set('lists', 'shorteners', args.shorteners)
-
-    # get final options
-    port = config.get('service', 'port')
-    extr = get_extractor(config.get('canonical', 'tldcache'))
-    timeout = config.getint('canonical', 'timeout')
-    maxsize = config.getint('canonical', 'maxsize')
-    maxclients = config.getint('canonical', 'maxclients')
+    if args.workers is not None:
+        config.set('workers', 'supervisor', 'yes')
+        config.set('workers', 'count', args.workers)
 
     # Save config
     if args.save_config is not None:
         save_config(config, args.save_config)
 
     # Setup logging
-    setup_logging(config)
+    request_log = setup_logging(config)
 
-    # Load Lists
-    whitelist, shorteners = load_lists(config)
+    # Lists and services: must exist before the workers are forked
+    ctx = build_context(config, request_log)
 
-    serve(port, whitelist, shorteners, extr, timeout, maxsize, maxclients)
+    port = config.get('service', 'port')
+    if not config.getboolean('workers', 'supervisor'):
+        serve(port, ctx)
+        return
+
+    drain = config.getint('workers', 'drain')
+
+    def run_worker(worker, ready):
+        serve_worker(worker, ready, port, ctx, drain_timeout=drain)
+
+    supervisor = Supervisor(run_worker,
+                            workers=config.getint('workers', 'count'),
+                            pin=config.getboolean('workers', 'pin'),
+                            drain_timeout=drain,
+                            on_exit=(ctx.budget.reclaim
+                                     if ctx.budget is not None else None))
+    supervisor.run()
 
 
 if __name__ == '__main__':
@@ -9,11 +9,14 @@ Failing that, returns redirect url if redirect happens.
 '''
 
 from __future__ import print_function
+import time
 import logging
 from httpget import get_web_page, get_web_page_async
 from urlhelpers import url_or_error
 from domainlists import check_whitelist
 from canonicalextract import process_page
+from memusage import RSSProbe
+from admission import OVERLOADED
 
 
 REQ_TIMEOUT = 30
@@ -50,7 +53,7 @@ def get_canonical_url(url, whitelist, expandlist, extract,
     #
     # fetch page
     #
-    page, enc, final_url, err = get_web_page(url, timeout)
+    page, enc, final_url, err = get_web_page(url, timeout, MAX_READ)
 
     # check final url from dowload attempt
     if final_url is not None:
@@ -75,16 +78,62 @@ def get_canonical_url(url, whitelist, expandlist, extract,
                 'method': method,
                 'reason': 'not in whitelist'}
 
-    return process_page(page, enc, url, ret_url, method)
+    return process_page_measured(page, enc, url, ret_url, method)
 
 
-def make_processed_handler(canonical_handler, whitelist, extract):
+def add_time(trace, key, started):
+    """Adds the time elapsed since started to a trace's stage timing
+    """
+    if trace is not None:
+        trace[key] = trace.get(key, 0.0) + time.time() - started
+
+
+def process_page_measured(page, enc, url, ret_url, method, trace=None,
+                          features=None):
+    """process_page, timing it into trace and logging (at DEBUG level) how
+    much it raised the worker's peak RSS
+    """
+    probe = None
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        probe = RSSProbe()
+    started = time.time()
+
+    result = process_page(page, enc, url, ret_url, method, trace, features)
+
+    if trace is not None:
+        trace['process_time'] = time.time() - started
+    if probe is not None:
+        probe.stop()
+        logging.debug('memory: %s page=%d peak_rss_growth=%dkB rss=%skB',
+                      url, len(page) if page is not None else 0,
+                      probe.growth, probe.rss)
+    return result
+
+
+def make_processed_handler(canonical_handler, ctx, cached=None, trace=None):
     """Returns a handler take processes the downloaded web page
+    If ctx has a cache, results are stored along with their validators and
+    a 304 Not Modified answer reuses the cached entry.
+    ctx.features is the PageFeatureCache passed on to process_page.
     """
+    cache = ctx.cache
+
     def processed_handler(data):
-        url, page, enc, final_url, err = data
+        url, page, enc, final_url, err, validators = data
         ret_url = None
         method = 'original'
+        if trace is not None and err is not None:
+            trace['error'] = err
+
+        # revalidated: reuse the stored result without parsing anything
+        if err == 'not modified' and cached is not None:
+            if trace is not None:
+                trace['cache'] = 'revalidated'
+            if cache is not None:
+                cache.refresh(url, validators)
+            canonical_handler(cached['result'])
+            return
+
         # check final url from dowload attempt
         if final_url is None:
             result = {'url_original': url,
@@ -95,40 +144,66 @@ def make_processed_handler(canonical_handler, whitelist, extract):
             return
 
         if final_url != url:
+            started = time.time()
             ret_url = url_or_error(final_url)
+            add_time(trace, 'validate_time', started)
             method = 'redirect'
-            msg = 'got redirect: {} -> {}'.format(url, final_url)
-            logging.debug(msg)
+            logging.debug('got redirect: %s -> %s', url, final_url)
         else:
             ret_url = url
 
         # check if whitelist exists
-        if not check_whitelist(ret_url, method, extract, whitelist):
+        started = time.time()
+        in_whitelist = check_whitelist(ret_url, method, ctx.extract,
+                                       ctx.whitelist)
+        add_time(trace, 'lists_time', started)
+        if not in_whitelist:
             result = {'url_original': url,
                       'url_retrieved': ret_url,
                       'method': None,
                       'reason': 'not in whitelist'}
+            if cache is not None:
+                cache.put(url, result, validators)
             canonical_handler(result)
             return
 
-        result = process_page(page, enc, url, ret_url, method)
+        result = process_page_measured(page, enc, url, ret_url, method,
+                                       trace, ctx.features)
+        if cache is not None and err is None:
+            cache.put(url, result, validators)
         canonical_handler(result)
 
     return processed_handler
 
 
-def get_canonical_url_async(url, whitelist, expandlist, extract,
-                            timeout, maxsize, maxclients, canonical_handler):
+def get_canonical_url_async(url, ctx, canonical_handler, refresh=False,
+                            trace=None, priority=None, caller=None):
     '''Get the canonical (or open graph) URL
     Returns a 4-tuple (original_url, new_url, method, reason)
 
     where method in ['canonical', 'redirect', 'original']
+
+    ctx is the ServiceContext: its lists, fetch settings and services.
+    If it has a CanonicalCache, fresh results are answered from it and
+    expired ones are revalidated with a conditional request.
+    A RefreshAhead refresher counts requests to find hot urls; refresh=True
+    revalidates the cached entry even if it is still fresh.
+    An AdmissionController may refuse the fetch: the stale cached result is
+    returned if there is one, otherwise reason is 'overloaded'.
+    trace is an optional dict that collects statistics about the request
+    (cache use, timings, bytes, redirects) for request logging.
+    Fetches get a slot from the SharedFetchBudget, wait in the FairQueue as
+    the given priority class and caller, are archived by the TraceRecorder
+    and made with ctx.http_client (to replay an archive) if there is one.
+    PageFeatureCache features hold extraction results by page content.
     '''
     method = 'original'
     ret_url = url
 
     # if it's not unicode, it must be utf8, otherwise fail
+    started = time.time()
     url_new = url_or_error(url)
+    add_time(trace, 'validate_time', started)
     if url_new is None:
         result = {'url_original': url,
                   'url_retrieved': None,
@@ -139,17 +214,55 @@ def get_canonical_url_async(url, whitelist, expandlist, extract,
 
     url = url_new
     # Only download URLs that are in the WHITELIST  or in the EXPANDLIST
-    if not (check_whitelist(url, method, extract, expandlist) or
-            check_whitelist(url, method, extract, whitelist)):
+    started = time.time()
+    in_lists = (check_whitelist(url, method, ctx.extract, ctx.expandlist) or
+                check_whitelist(url, method, ctx.extract, ctx.whitelist))
+    add_time(trace, 'lists_time', started)
+    if not in_lists:
         result = {'url_original': url,
                   'url_retrieved': ret_url,
                   'method': method,
                   'reason': 'not in lists'}
-        logging.debug('passing result 1')
+        canonical_handler(result)
+        return
+
+    # answer from cache while fresh, revalidate once expired
+    cached = None
+    if ctx.cache is not None:
+        cached = ctx.cache.get(url)
+        if ctx.refresher is not None and not refresh:
+            ctx.refresher.record(url, cached)
+        if cached is not None and not refresh and ctx.cache.is_fresh(cached):
+            if trace is not None:
+                trace['cache'] = 'hit'
+            canonical_handler(cached['result'])
+            return
+
+    # everything above is answered locally, only fetches can be shed
+    admission = ctx.admission
+    if admission is not None and not admission.admit(ctx.fetch_queue,
+                                                     priority):
+        if cached is not None:
+            if trace is not None:
+                trace['cache'] = 'stale'
+            canonical_handler(cached['result'])
+            return
+        result = {'url_original': url,
+                  'url_retrieved': None,
+                  'method': None,
+                  'reason': OVERLOADED}
         canonical_handler(result)
         return
 
     # fetch page
-    processed_handler = make_processed_handler(canonical_handler, whitelist,
-                                               extract)
-    get_web_page_async(url, timeout, maxsize, maxclients, processed_handler)
+    if trace is not None and ctx.cache is not None:
+        trace['cache'] = 'miss' if cached is None else 'expired'
+    processed_handler = make_processed_handler(canonical_handler, ctx, cached,
+                                               trace)
+    if trace is not None and ctx.fetch_queue is not None:
+        trace['priority'] = priority
+    get_web_page_async(url, ctx.timeout, ctx.maxsize, ctx.maxclients,
+                       processed_handler, cached=cached, trace=trace,
+                       budget=ctx.budget, fetch_queue=ctx.fetch_queue,
+                       priority=priority, caller=caller,
+                       recorder=ctx.recorder, http_client=ctx.http_client)
@@ -0,0 +1,563 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Crawl trace recording and deterministic replay
+
+TraceRecorder saves every fetched hop as a pair of WARC records (request
+and response, one gzip member each, so the archive is append-only and can be
+read with any WARC tool). The response record holds the status line, the
+headers and the body as received (de-chunked but still compressed, cut like
+the page was at maxsize bytes and then marked WARC-Truncated). Hop-by-hop
+headers are left out and Content-Length is that of the stored body, so the
+record reads as a plain HTTP message; Content-Encoding is kept as it still
+describes the body,
+plus the request's url, the hop number in its redirect chain, the time the
+request started and the time the hop took. As with the request log, records
+are queued by the IOLoop and compressed and written by a thread, one file per
+worker, and hops are dropped rather than queued past a number of hops or
+of body bytes. Each hop is appended with a single write, so a replacement
+worker and the one it replaces (still draining) can share the file.
+
+ReplayHTTPClient answers fetches from archives through AsyncHTTPClient's
+interface, with the recorded timing or as fast as possible, so a trace runs
+through the same redirect, body decoding and extraction code as the original
+requests did. Record with the result cache off: revalidations (304s) have
+nothing to be checked against on replay.
+
+    python crawltrace.py replay trace.*.warc.gz > new.ndjson
+    python crawltrace.py compare old.ndjson new.ndjson
+"""
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import uuid
+import zlib
+import random
+import logging
+import argparse
+import resource
+import threading
+import Queue
+from io import BytesIO
+from collections import deque, Counter
+from tornado.ioloop import IOLoop
+from tornado.httputil import HTTPHeaders, responses
+from tornado.httpclient import HTTPRequest, HTTPResponse
+
+
+QUEUE_SIZE = 1000  # hops waiting to be written, the rest are dropped
+QUEUE_BYTES = 64 * 1024 * 1024  # body bytes of the hops waiting
+CHUNK_SIZE = 64 * 1024
+TIMINGS = ('original', 'fast')
+
+WARC_VERSION = b'WARC/1.0'
+# extension fields of the response records
+REQUEST_FIELD = 'X-Canonical-Request-URI'
+HOP_FIELD = 'X-Canonical-Hop'
+STARTED_FIELD = 'X-Canonical-Started'
+FETCH_TIME_FIELD = 'X-Canonical-Fetch-Time'
+ERROR_FIELD = 'X-Canonical-Error'
+# not recorded: they describe the connection, not the stored body
+HOP_BY_HOP = frozenset(['connection', 'keep-alive', 'proxy-authenticate',
+                        'proxy-authorization', 'te', 'trailer',
+                        'transfer-encoding', 'upgrade', 'content-length'])
+
+
+def warc_date(timestamp):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp))
+
+
+def field_value(value):
+    """Header or field value on a single line
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf8')
+    return str(value).replace('\r', ' ').replace('\n', ' ')
+
+
+def record_headers(headers, size):
+    """Response headers as recorded with a body of size bytes
+    """
+    headers = [(name, value) for name, value in headers
+               if name.lower() not in HOP_BY_HOP]
+    return headers + [('Content-Length', size)]
+
+
+def warc_record(kind, url, timestamp, content_type, block, fields=()):
+    """A gzip compressed WARC record
+    """
+    lines = [WARC_VERSION,
+             'WARC-Type: ' + kind,
+             'WARC-Record-ID: <urn:uuid:{}>'.format(uuid.uuid4()),
+             'WARC-Date: ' + warc_date(timestamp),
+             'WARC-Target-URI: ' + field_value(url),
+             'Content-Type: ' + content_type]
+    lines += ['{}: {}'.format(name, field_value(value))
+              for name, value in fields]
+    lines.append('Content-Length: {}'.format(len(block)))
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    data = compressor.compress(b'\r\n'.join(lines) + b'\r\n\r\n')
+    data += compressor.compress(block)
+    data += compressor.compress(b'\r\n\r\n')
+    return data + compressor.flush()
+
+
+class HopTap(object):
+    """Stands in for a BodyReader, keeping a copy of what it is fed
+    Nothing is kept once the reader is truncated or the copy has the
+    reader's maxsize bytes: truncated is set instead.
+    """
+    def __init__(self, url, hop_url, hop, started, headers, reader):
+        self.url = url
+        self.hop_url = hop_url
+        self.hop = hop
+        self.started = started
+        self.headers = dict(headers)
+        self.reader = reader
+        self.reset()
+
+    def reset(self):
+        self.chunks = []
+        self.size = 0
+        self.truncated = False
+
+    def header_line(self, line):
+        if line.startswith('HTTP/'):
+            self.reset()  # as the reader does, for a new response
+        self.reader.header_line(line)
+
+    def data_received(self, chunk):
+        kept = b'' if self.reader.truncated else \
+            chunk[:self.reader.maxsize - self.size]
+        if len(kept) < len(chunk):
+            self.truncated = True
+        if kept:
+            self.chunks.append(kept)
+            self.size += len(kept)
+        return self.reader.data_received(chunk)
+
+
+class TraceRecorder(object):
+    """Per-worker crawl trace archive
+    Args:
+        path - archive file; {worker} and {pid} are replaced in each worker
+        sample - fraction of requests recorded (with all their hops)
+        queuesize, queuebytes - most hops, and body bytes, waiting to be
+                                written
+    """
+    def __init__(self, path, sample=1.0, queuesize=QUEUE_SIZE,
+                 queuebytes=QUEUE_BYTES):
+        self.path = path
+        self.sample = sample
+        self.queue = Queue.Queue(queuesize)
+        self.queuebytes = queuebytes
+        self.queued_bytes = 0
+        self.lock = threading.Lock()  # queued_bytes, shared with the writer
+        self.thread = None
+        self.recorded = 0
+        self.dropped = 0
+
+    def start(self, worker):
+        """Starts this worker's writer thread (must be called after forking)
+        """
+        path = self.path.format(worker=worker, pid=os.getpid())
+        self.thread = threading.Thread(target=self.run, args=(path,),
+                                       name='trace-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, path):
+        # no buffering: a hop is one write on an O_APPEND descriptor
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                try:
+                    os.write(fd, self.encode(*item))
+                except Exception as ex:
+                    logging.exception(ex)
+                with self.lock:
+                    self.queued_bytes -= item[0].size
+        finally:
+            os.close(fd)
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+            logging.info('trace: %d hops recorded, %d dropped', self.recorded,
+                         self.dropped)
+
+    def sampled(self):
+        """Whether to record a new request
+        """
+        return self.sample >= 1.0 or random.random() < self.sample
+
+    def tap(self, url, hop_url, hop, started, headers, reader):
+        """Wraps the reader of a hop, to be fed by the HTTP client
+        url is the requested url, hop the number of redirects before this
+        hop and started the time the request started.
+        """
+        return HopTap(url, hop_url, hop, started, headers, reader)
+
+    def make_record_handler(self, tap, callback):
+        """Wraps a fetch callback so that it first records the hop
+        """
+        def record_handler(response):
+            try:
+                self.put((tap, response.code, response.reason,
+                          list(response.headers.get_all()),
+                          response.error, response.request_time))
+            except Exception as ex:
+                logging.exception(ex)
+            callback(response)
+        return record_handler
+
+    def put(self, item):
+        """Queues a hop for the writer, unless too much is queued already
+        """
+        size = item[0].size
+        with self.lock:
+            if self.queued_bytes + size > self.queuebytes:
+                self.dropped += 1
+                return
+            self.queued_bytes += size
+        try:
+            self.queue.put_nowait(item)
+            self.recorded += 1
+        except Queue.Full:
+            with self.lock:
+                self.queued_bytes -= size
+            self.dropped += 1
+
+    def encode(self, tap, code, reason, headers, error, fetch_time):
+        """Request and response records of a hop
+        """
+        request = ['GET {} HTTP/1.1'.format(field_value(tap.hop_url))]
+        request += ['{}: {}'.format(name, field_value(value))
+                    for name, value in sorted(tap.headers.items())]
+        request = b'\r\n'.join(request) + b'\r\n\r\n'
+
+        response = ['HTTP/1.1 {} {}'.format(
+            code, field_value(reason or responses.get(code, 'Unknown')))]
+        response += ['{}: {}'.format(name, field_value(value))
+                     for name, value in record_headers(headers, tap.size)]
+        response = b'\r\n'.join(response) + b'\r\n\r\n' + b''.join(tap.chunks)
+
+        fields = [(REQUEST_FIELD, tap.url),
+                  (HOP_FIELD, tap.hop),
+                  (STARTED_FIELD, repr(tap.started))]
+        if fetch_time is not None:
+            fields.append((FETCH_TIME_FIELD, repr(fetch_time)))
+        if code == 599 and error is not None:
+            fields.append((ERROR_FIELD, str(error)))
+        if tap.truncated:
+            fields.append(('WARC-Truncated', 'length'))
+        return (warc_record('request', tap.hop_url, tap.started,
+                            'application/http; msgtype=request', request) +
+                warc_record('response', tap.hop_url, tap.started,
+                            'application/http; msgtype=response', response,
+                            fields))
+
+
+def read_members(fin):
+    """Decompressed gzip members of a file, one at a time
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    parts = []
+    data = fin.read(CHUNK_SIZE)
+    while data:
+        parts.append(decompressor.decompress(data))
+        data = decompressor.unused_data
+        if data:
+            # the member ended in this chunk, the rest starts the next one
+            yield b''.join(parts)
+            parts = []
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            data = fin.read(CHUNK_SIZE)
+    if parts:
+        try:
+            parts.append(decompressor.flush())
+        except zlib.error:
+            pass
+        yield b''.join(parts)
+
+
+def parse_record(data):
+    """(fields, block) of a WARC record, None if it is incomplete
+    """
+    head, sep, rest = data.partition(b'\r\n\r\n')
+    lines = head.split(b'\r\n')
+    if not sep or lines[0] != WARC_VERSION:
+        return None
+    fields = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        fields[name.strip()] = value.strip()
+    length = int(fields.get('Content-Length', -1))
+    if length < 0 or len(rest) < length:
+        return None
+    return fields, rest[:length]
+
+
+class RecordedResponse(object):
+    """A response record, as needed to play it back
+    """
+    def __init__(self, fields, block):
+        self.url = fields['WARC-Target-URI']
+        self.request_url = fields.get(REQUEST_FIELD, self.url)
+        self.hop = int(fields.get(HOP_FIELD, 0))
+        self.started = float(fields.get(STARTED_FIELD, 0))
+        self.fetch_time = float(fields.get(FETCH_TIME_FIELD, 0))
+        self.error = fields.get(ERROR_FIELD)
+
+        head, _, self.body = block.partition(b'\r\n\r\n')
+        lines = head.split(b'\r\n')
+        status = lines[0].split(' ', 2)
+        self.code = int(status[1])
+        self.reason = status[2] if len(status) > 2 else None
+        # lines as tornado passes them to header_callback
+        self.header_lines = [line + '\r\n' for line in lines] + ['\r\n']
+        self.headers = HTTPHeaders()
+        for line in lines[1:]:
+            self.headers.parse_line(line)
+
+
+def read_archive(paths):
+    """RecordedResponses of archive files, in the order they were written
+    """
+    for path in paths:
+        with open(path, 'rb') as fin:
+            for data in read_members(fin):
+                record = parse_record(data)
+                if record is None:
+                    logging.warning('trace: incomplete record in %s', path)
+                    continue
+                if record[0].get('WARC-Type') == 'response':
+                    yield RecordedResponse(*record)
+
+
+class ReplayError(Exception):
+    """Error of a recorded network failure, same message as the original
+    """
+
+
+class ReplayHTTPClient(object):
+    """Answers fetches from recorded responses (AsyncHTTPClient.fetch)
+    Args:
+        responses - RecordedResponses
+        timing - 'original': answer after the recorded fetch time,
+                 'fast': as soon as possible
+
+    A url recorded more than once is answered with its responses in order,
+    the last one is repeated. Urls that were not recorded fail like an
+    unreachable host.
+    """
+    def __init__(self, responses, timing='fast', io_loop=None):
+        self.timing = timing
+        self.io_loop = io_loop or IOLoop.current()
+        self.responses = {}
+        self.requests = []
+        for response in responses:
+            self.responses.setdefault(response.url, deque()).append(response)
+            if response.hop == 0:
+                self.requests.append((response.started, response.request_url))
+        self.requests.sort()
+        self.missing = 0
+
+    def get_response(self, url):
+        recorded = self.responses.get(url)
+        if not recorded:
+            return None
+        return recorded.popleft() if len(recorded) > 1 else recorded[0]
+
+    def fetch(self, request, callback, header_callback=None,
+              streaming_callback=None, **kwargs):
+        if not isinstance(request, HTTPRequest):
+            request = HTTPRequest(request, **kwargs)
+        recorded = self.get_response(request.url)
+        if recorded is None:
+            self.missing += 1
+
+        def answer():
+            callback(self.play(request, recorded, header_callback,
+                               streaming_callback))
+
+        if self.timing == 'original' and recorded is not None:
+            self.io_loop.call_later(recorded.fetch_time, answer)
+        else:
+            self.io_loop.add_callback(answer)
+
+    def play(self, request, recorded, header_callback, streaming_callback):
+        """Feeds a recorded response to the callbacks, returns it
+        """
+        if recorded is None:
+            return HTTPResponse(request, 599, request_time=0.0,
+                                error=ReplayError('not in trace'))
+        if recorded.error is not None:
+            return HTTPResponse(request, recorded.code,
+                                request_time=recorded.fetch_time,
+                                error=ReplayError(recorded.error))
+
+        if header_callback is not None:
+            for line in recorded.header_lines:
+                header_callback(line)
+        body = recorded.body
+        buf = None
+        if streaming_callback is not None:
+            for start in xrange(0, len(body), CHUNK_SIZE):
+                streaming_callback(body[start:start + CHUNK_SIZE])
+        else:
+            buf = BytesIO(body)
+        return HTTPResponse(request, recorded.code, reason=recorded.reason,
+                            headers=recorded.headers, buffer=buf,
+                            effective_url=request.url,
+                            request_time=recorded.fetch_time)
+
+    def close(self):
+        pass
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def replay(client, resolve, fmt, out, concurrency=100):
+    """Resolves the recorded requests again, writing the results to out
+    resolve(url, handler, trace) resolves a url through client.
+    With original timing requests start at their recorded offsets.
+    Returns a summary: counts, wall and CPU time, summed stage timings.
+    """
+    # imported here: the service (which canonicalbulk uses) imports this
+    from canonicalbulk import BulkResolver
+
+    traces = []
+    requests = client.requests
+    first = requests[0][0] if requests else 0.0
+    starts = iter(started for started, _ in requests)
+    begun = time.time()
+
+    def resolve_traced(url, handler):
+        trace = {'url': url, 'start': time.time()}
+        traces.append(trace)
+        started = next(starts)
+        if client.timing != 'original':
+            resolve(url, handler, trace)
+            return
+        delay = started - first - (time.time() - begun)
+        client.io_loop.call_later(max(delay, 0.0), resolve, url, handler,
+                                  trace)
+
+    if client.timing == 'original':
+        concurrency = max(len(requests), 1)
+    resolver = BulkResolver(resolve_traced, fmt, out, concurrency)
+    cpu = cpu_time()
+    resolver.run(url for _, url in requests)
+
+    stages = Counter()
+    for trace in traces:
+        for key, value in trace.items():
+            if key.endswith('_time') and isinstance(value, float):
+                stages[key] += value
+    return {'requests': len(requests),
+            'written': resolver.written,
+            'missing': client.missing,
+            'timing': client.timing,
+            'wall_time': time.time() - begun,
+            'cpu_time': cpu_time() - cpu,
+            'stages': dict(stages)}
+
+
+def compare(old, new, fmt, limit=20):
+    """Differences between two result files of the same trace
+    """
+    def load(path):
+        with open(path, 'rb') as fin:
+            return fmt.decode(fin.read())
+
+    old, new = load(old), load(new)
+    changed = [(a, b) for a, b in zip(old, new)
+               if (a.get('url_retrieved'), a.get('reason')) !=
+               (b.get('url_retrieved'), b.get('reason'))]
+    return {'old': len(old),
+            'new': len(new),
+            'changed': len(changed),
+            'examples': changed[:limit]}
+
+
+def main():
+    # imported here: canonicalservice imports this module
+    from canonicalservice import init_config, read_config_file, build_context
+    from canonicalformat import FORMATS, get_format
+    from canonicalurl import get_canonical_url_async
+
+    parser = argparse.ArgumentParser(description='Crawl trace replay.')
+    parser.add_argument('--format', type=str, default='ndjson',
+                        choices=[f.name for f in FORMATS],
+                        help='format of result files')
+    subparsers = parser.add_subparsers(dest='command')
+
+    play = subparsers.add_parser(
+        'replay', help='resolve the requests of archives again, results to '
+                       'stdout, summary to stderr')
+    play.add_argument('archives', nargs='+')
+    play.add_argument('--config', type=str, default=None,
+                      help='configuration file')
+    play.add_argument('--timing', choices=TIMINGS, default='fast')
+    play.add_argument('--concurrency', type=int, default=0,
+                      help='urls resolved at a time with fast timing '
+                           '(default: maxclients)')
+
+    diff = subparsers.add_parser('compare', help='compare two result files')
+    diff.add_argument('old')
+    diff.add_argument('new')
+    diff.add_argument('--limit', type=int, default=20,
+                      help='changed results listed')
+
+    info = subparsers.add_parser('info', help='describe archives')
+    info.add_argument('archives', nargs='+')
+    args = parser.parse_args()
+
+    fmt = get_format(args.format)
+    if args.command == 'compare':
+        print(json.dumps(compare(args.old, args.new, fmt, args.limit),
+                         indent=2))
+        return
+
+    if args.command == 'info':
+        hops = list(read_archive(args.archives))
+        print(json.dumps({'hops': len(hops),
+                          'requests': sum(1 for h in hops if h.hop == 0),
+                          'body_bytes': sum(len(h.body) for h in hops),
+                          'codes': Counter(h.code for h in hops)}, indent=2))
+        return
+
+    config = init_config()
+    config = read_config_file(config, filepath=args.config)
+    logging.basicConfig(filename=config.get('service', 'log'), filemode='a',
+                        format="%(asctime)-15s %(process)d: %(message)s",
+                        level=config.getint('service', 'loglevel'))
+
+    client = ReplayHTTPClient(read_archive(args.archives), args.timing)
+    # no caches: every request is fetched (from the trace) and processed
+    ctx = build_context(config, caches=False, service=False,
+                        http_client=client)
+
+    def resolve(url, handler, trace):
+        get_canonical_url_async(url, ctx, handler, trace=trace)
+
+    summary = replay(client, resolve, fmt, sys.stdout,
+                     args.concurrency or ctx.maxclients)
+    print(json.dumps(summary, indent=2), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,14 +4,25 @@ Domain Whitelists
 
 
 import logging
-import tldextract
+from publicsuffix import TABLE, SuffixTable, SuffixExtractor
 
 
-def get_extractor(cache_file):
-    """Creates a domain extractor with a specific cache
+_defaults = {}
+
+
+def get_extractor(table_path=None, include_private=False):
+    """Creates a domain extractor from a compiled public suffix table
+    (the bundled snapshot if table_path is empty)
+    """
+    return SuffixExtractor(SuffixTable(table_path or TABLE), include_private)
+
+
+def get_default_extractor():
+    """Extractor of the bundled snapshot, created on first use
     """
-    extract = tldextract.TLDExtract(cache_file=cache_file)
-    return extract
+    if 'extract' not in _defaults:
+        _defaults['extract'] = get_extractor()
+    return _defaults['extract']
 
 
 def load_list(listpath):
@@ -31,18 +42,18 @@ def load_list(listpath):
     return domain_list
 
 
-def check_whitelist(url, method='missing method', extract=tldextract.extract,
+def check_whitelist(url, method='missing method', extract=None,
                     whitelist=None):
     """If whitelist exists, check if url's domain is in it.
     """
     if whitelist:
         try:
+            if extract is None:
+                extract = get_default_extractor()
             domain = extract(url).registered_domain.lower()
             # check if url is in whitelist
             if domain not in whitelist:
-                domain = domain.encode('utf8')
-                msg = "not in domain list:\t{} ({})".format(domain, method)
-                logging.debug(msg)
+                logging.debug('not in domain list:\t%s (%s)', domain, method)
                 return False
         except Exception as ex:
             logging.warning(ex)
@@ -0,0 +1,294 @@
+"""
+Weighted fair queuing of a worker's fetches
+
+Every request has a priority class (from an API key mapping or a header)
+and a caller (its API key, or its address). Fetches wait here until one of
+the worker's fetch slots is free. Classes share the slots in proportion to
+their weights (start-time fair queuing), callers of a class take turns, and
+no caller gets more than its quota of slots at a time, so a bulk job cannot
+starve interactive lookups however many urls it sends. load() gives the
+admission controller the backlog and wait a new fetch of a class would see.
+
+With a SharedFetchBudget, a fetch only leaves the queue (and counts as
+active) once it holds a budget slot. The classes' turns therefore also
+decide who gets the instance's slots, and time spent waiting for the
+budget is part of the class's wait.
+"""
+
+import time
+import logging
+from collections import deque, OrderedDict
+from tornado.ioloop import IOLoop
+from fetchbudget import DENIED_GLOBAL, POLL_INTERVAL
+
+
+CLASSES = 'interactive:8, normal:4, bulk:1'
+DEFAULT_CLASS = 'normal'
+PRIORITY_HEADER = 'X-Priority'
+KEY_HEADER = 'X-API-Key'
+CALLER_QUOTA = 50
+HOST_SCAN = 16  # queued fetches of a caller tried when hosts are at limit
+WAIT_SAMPLES = 1000  # recent waits kept per class for percentiles
+WAIT_ALPHA = 0.2
+WAIT_HALFLIFE = 5.0  # seconds, decay of a class's wait while none dispatch
+
+
+def parse_pairs(value, convert=str):
+    """'a:1, b:2' -> OrderedDict([('a', convert('1')), ('b', convert('2'))])
+    """
+    pairs = OrderedDict()
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, arg = item.rpartition(':')
+        pairs[name.strip()] = convert(arg.strip())
+    return pairs
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+class PriorityClass(object):
+    """Queued fetches of a class, per caller, and its wait statistics
+    """
+    def __init__(self, name, weight):
+        self.name = name
+        self.weight = float(weight)
+        self.vtime = 0.0
+        # caller -> deque of (start, queued at, host)
+        self.callers = OrderedDict()
+        self.queued = 0
+        self.active = 0
+        self.dispatched = 0
+        self.waits = deque(maxlen=WAIT_SAMPLES)
+        self.wait = 0.0
+        self.wait_updated = 0.0
+
+    def record_wait(self, wait):
+        """Adds a dispatched fetch's wait (seconds) to the moving average
+        """
+        self.waits.append(wait)
+        self.wait = self.recent_wait()
+        self.wait += WAIT_ALPHA * (wait - self.wait)
+        self.wait_updated = time.time()
+
+    def recent_wait(self):
+        """Recent average wait, decaying while no fetch is dispatched
+        """
+        idle = time.time() - self.wait_updated
+        return self.wait * 0.5 ** (idle / WAIT_HALFLIFE)
+
+    def oldest_wait(self):
+        """Seconds the longest queued fetch has been waiting
+        """
+        if not self.queued:
+            return 0.0
+        oldest = min(queue[0][1] for queue in self.callers.itervalues())
+        return time.time() - oldest
+
+    def stats(self):
+        waits = sorted(self.waits)
+        return {'weight': self.weight,
+                'queued': self.queued,
+                'active': self.active,
+                'dispatched': self.dispatched,
+                'callers': len(self.callers),
+                'wait': self.recent_wait(),
+                'wait_p50': percentile(waits, 0.5),
+                'wait_p99': percentile(waits, 0.99),
+                'wait_max': waits[-1] if waits else None}
+
+
+class FairQueue(object):
+    """Per worker queue of fetches in front of the HTTP client
+    Args:
+        maxactive - fetches started at a time (the worker's maxclients)
+        classes - OrderedDict of class name -> weight
+        default - class of requests that do not ask for a known one
+        quota - fetches a caller may have started at a time (0: no limit)
+        keys - dict of API key -> class name
+        budget - SharedFetchBudget fetches take a slot of before starting
+    """
+    def __init__(self, maxactive, classes=None, default=DEFAULT_CLASS,
+                 quota=CALLER_QUOTA, keys=None, header=PRIORITY_HEADER,
+                 keyheader=KEY_HEADER, budget=None):
+        if classes is None:
+            classes = parse_pairs(CLASSES, float)
+        self.maxactive = maxactive
+        self.classes = OrderedDict((name, PriorityClass(name, weight))
+                                   for name, weight in classes.items())
+        self.default = default if default in self.classes else \
+            next(iter(self.classes))
+        self.quota = quota
+        self.keys = keys or {}
+        self.header = header
+        self.keyheader = keyheader
+        self.active = 0
+        self.vclock = 0.0
+        self.caller_active = {}
+        self.over_quota = 0
+        self.budget = budget
+        self.timeout = None
+
+    def lowest(self):
+        """Name of the class with the smallest weight
+        """
+        return min(self.classes.values(), key=lambda c: c.weight).name
+
+    def classify(self, headers, remote_ip):
+        """(class, caller) of a request
+        A known API key decides the class and is the caller, the priority
+        header is used otherwise and callers are told apart by address
+        (a made up key must not get a quota of its own).
+        """
+        key = headers.get(self.keyheader)
+        if key and key in self.keys:
+            return self.keys[key], 'key:' + key
+
+        priority = headers.get(self.header)
+        if priority not in self.classes:
+            priority = self.default
+        return priority, remote_ip
+
+    def get_class(self, priority):
+        return self.classes.get(priority) or self.classes[self.default]
+
+    def load(self, priority=None):
+        """(fetches, seconds) a new fetch of a class would be behind
+        fetches are those queued or started in classes weighing at least as
+        much: lighter classes only get their share of the slots however many
+        fetches they queue. seconds is the class's recent wait for a slot, or
+        the age of its oldest queued fetch if that is longer.
+        """
+        cls = self.get_class(priority)
+        fetches = sum(other.queued + other.active
+                      for other in self.classes.itervalues()
+                      if other.weight >= cls.weight)
+        return fetches, max(cls.recent_wait(), cls.oldest_wait())
+
+    def submit(self, start, priority=None, caller=None, host=None):
+        """Calls start() once the fetch's turn has come (and it holds a
+        budget slot for host)
+        """
+        cls = self.get_class(priority)
+        if not cls.queued:
+            # an idle class gets no credit for the time it was idle
+            cls.vtime = max(cls.vtime, self.vclock)
+        cls.callers.setdefault(caller, deque()).append(
+            (start, time.time(), host))
+        cls.queued += 1
+        self.dispatch()
+
+    def release(self, priority=None, caller=None, host=None):
+        """Frees the slots of a finished fetch and starts queued ones
+        """
+        if self.budget is not None:
+            self.budget.release(host)
+        cls = self.get_class(priority)
+        cls.active -= 1
+        self.active -= 1
+        active = self.caller_active.get(caller, 1) - 1
+        if active > 0:
+            self.caller_active[caller] = active
+        else:
+            self.caller_active.pop(caller, None)
+        self.dispatch()
+
+    def take(self, cls, blocked):
+        """Takes the next fetch of cls that may start: its caller is under
+        quota and it holds a budget slot
+        blocked collects the hosts denied a slot, DENIED_GLOBAL is returned
+        if the budget is exhausted, None if no fetch of cls can start.
+        """
+        eligible = False
+        for caller in cls.callers:
+            if self.quota and self.caller_active.get(caller, 0) >= self.quota:
+                continue
+            eligible = True
+            queue = cls.callers[caller]
+            for index in xrange(min(len(queue), HOST_SCAN)):
+                host = queue[index][2]
+                if self.budget is not None:
+                    if host in blocked:
+                        continue
+                    denied = self.budget.try_acquire(host)
+                    if denied == DENIED_GLOBAL:
+                        return DENIED_GLOBAL
+                    if denied is not None:
+                        blocked.add(host)
+                        continue
+                entry = queue[index]
+                del queue[index]
+                del cls.callers[caller]
+                if queue:
+                    cls.callers[caller] = queue  # back of the line
+                return caller, entry
+        if not eligible:
+            self.over_quota += 1
+        return None
+
+    def dispatch(self):
+        """Starts queued fetches while there are free slots
+        Classes are served in order of their virtual time. A class whose
+        fetches cannot start (callers over quota, hosts at their budget
+        limit) lets the next one have the slot.
+        """
+        blocked = set()
+        while self.active < self.maxactive:
+            taken = None
+            queued = [c for c in self.classes.itervalues() if c.queued]
+            # stable: ties go to the class configured first
+            for cls in sorted(queued, key=lambda c: c.vtime):
+                taken = self.take(cls, blocked)
+                if taken is not None:
+                    break
+
+            if taken == DENIED_GLOBAL or (taken is None and blocked):
+                self.schedule()  # other workers free slots silently
+                return
+            if taken is None:
+                return
+
+            caller, (start, queued_at, host) = taken
+            cls.queued -= 1
+            cls.active += 1
+            cls.dispatched += 1
+            cls.record_wait(time.time() - queued_at)
+            self.vclock = cls.vtime
+            cls.vtime += 1.0 / cls.weight
+            self.active += 1
+            self.caller_active[caller] = self.caller_active.get(caller, 0) + 1
+            start()
+
+    def schedule(self):
+        if self.timeout is None:
+            self.timeout = IOLoop.current().call_later(POLL_INTERVAL,
+                                                       self.poll)
+
+    def poll(self):
+        self.timeout = None
+        self.dispatch()
+
+    def make_release_handler(self, priority, caller, callback, host=None):
+        """Wraps a fetch callback so that it first releases the fetch's slots
+        """
+        def release_handler(response):
+            try:
+                self.release(priority, caller, host)
+            except Exception as ex:
+                logging.exception(ex)
+            callback(response)
+        return release_handler
+
+    def stats(self):
+        return {'active': self.active,
+                'maxactive': self.maxactive,
+                'callers': len(self.caller_active),
+                'over_quota': self.over_quota,
+                'budget_waiting': self.timeout is not None,
+                'classes': dict((name, cls.stats())
+                                for name, cls in self.classes.items())}
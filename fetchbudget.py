@@ -0,0 +1,310 @@
+"""
+Outbound fetch budget shared by all forked workers of an instance
+
+Counters live in an anonymous shared mmap segment that is created before the
+workers are forked, guarded by a process shared lock. They enforce a global
+and a per-host limit on concurrent fetches plus optional token bucket rates
+(global and per host). Fetches that do not fit wait in a per-worker queue.
+
+Hosts are hashed into a fixed number of slots, so two hosts may share a
+slot: limits are then applied to both together (never exceeded).
+
+Each worker also counts the fetch slots it holds in its own row of the
+segment. A worker that dies with fetches in flight (drain deadline, crash,
+SIGKILL) never releases them: its slots are reclaimed from its row when the
+supervisor reaps it, or when a new worker finds its pid dead.
+"""
+
+import os
+import mmap
+import time
+import zlib
+import errno
+import struct
+import logging
+from collections import deque
+from tornado.ioloop import IOLoop
+from sharedlock import SharedLock
+
+
+# in flight, tokens, last refill, acquired, denied (global, host)
+HEADER = struct.Struct('=qddQQQ')
+# in flight, tokens, last refill
+SLOT = struct.Struct('=qdd')
+# worker rows: pid, in flight, then the in flight count of each host slot
+OWNER = struct.Struct('=iq')
+OWNER_SLOT = struct.Struct('=H')
+
+HOST_SLOTS = 4096
+MAX_OWNERS = 64  # workers (including draining ones) at a time
+POLL_INTERVAL = 0.01  # seconds between retries of waiting fetches
+
+DENIED_GLOBAL = 'global'
+DENIED_HOST = 'host'
+
+
+def capacity(rate):
+    """Size of a token bucket: one second of rate, at least one token
+    """
+    return max(1.0, rate)
+
+
+def refill(tokens, last, now, rate):
+    """Token bucket refill
+    """
+    return min(capacity(rate), tokens + (now - last) * rate)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as ex:
+        return ex.errno == errno.EPERM
+    return True
+
+
+class SharedFetchBudget(object):
+    """Global and per-host outbound concurrency and rate limits
+    Args:
+        maxclients - concurrent fetches for the whole instance (0: no limit)
+        perhost - concurrent fetches per host (0: no limit)
+        rate - fetches per second for the whole instance (0: no limit)
+        hostrate - fetches per second per host (0: no limit)
+        slots - number of per-host slots
+        owners - number of worker rows
+
+    Must be created before forking.
+    """
+    def __init__(self, maxclients=100, perhost=16, rate=0, hostrate=0,
+                 slots=HOST_SLOTS, owners=MAX_OWNERS):
+        self.maxclients = maxclients
+        self.perhost = perhost
+        self.rate = float(rate)
+        self.hostrate = float(hostrate)
+        self.slots = slots
+        self.owners = owners
+        self.owner_size = OWNER.size + OWNER_SLOT.size * slots
+        self.lock = SharedLock()
+        self.shm = mmap.mmap(-1, self.owner_offset(owners))
+
+        now = time.time()
+        HEADER.pack_into(self.shm, 0, 0, capacity(self.rate), now, 0, 0, 0)
+        for slot in xrange(slots):
+            SLOT.pack_into(self.shm, self.slot_offset(slot), 0,
+                           capacity(self.hostrate), now)
+
+        # per worker
+        self.waiting = deque()
+        self.timeout = None
+        self.owner = None
+        self.owner_pid = None
+
+    def slot_offset(self, slot):
+        return HEADER.size + SLOT.size * slot
+
+    def owner_offset(self, owner):
+        return HEADER.size + SLOT.size * self.slots + self.owner_size * owner
+
+    def get_owner(self):
+        """Row of this process, claimed on first use (lock held)
+        Rows of dead processes are reclaimed on the way.
+        """
+        pid = os.getpid()
+        if self.owner_pid == pid:
+            return self.owner
+
+        self.owner = None
+        self.owner_pid = pid
+        for owner in xrange(self.owners):
+            owner_pid = OWNER.unpack_from(self.shm,
+                                          self.owner_offset(owner))[0]
+            # a row with our pid was left by a dead process (pid reuse)
+            if owner_pid and (owner_pid == pid or not pid_alive(owner_pid)):
+                self.clear_owner(owner)
+                owner_pid = 0
+            if self.owner is None and not owner_pid:
+                self.owner = owner
+        if self.owner is None:
+            logging.warning('fetch budget: no free worker row for %d', pid)
+        else:
+            OWNER.pack_into(self.shm, self.owner_offset(self.owner), pid, 0)
+        return self.owner
+
+    def count_owner(self, slot, delta):
+        """Adds delta to this process' fetches on a host slot (lock held)
+        """
+        owner = self.get_owner()
+        if owner is None:
+            return
+        offset = self.owner_offset(owner)
+        pid, inflight = OWNER.unpack_from(self.shm, offset)
+        OWNER.pack_into(self.shm, offset, pid, max(0, inflight + delta))
+        offset += OWNER.size + OWNER_SLOT.size * slot
+        count = OWNER_SLOT.unpack_from(self.shm, offset)[0]
+        OWNER_SLOT.pack_into(self.shm, offset, max(0, count + delta))
+
+    def clear_owner(self, owner):
+        """Releases every slot held by a row and frees it (lock held)
+        Returns the number of fetches that were in flight.
+        """
+        offset = self.owner_offset(owner)
+        pid, inflight = OWNER.unpack_from(self.shm, offset)
+        if inflight:
+            header = list(HEADER.unpack_from(self.shm, 0))
+            header[0] = max(0, header[0] - inflight)
+            HEADER.pack_into(self.shm, 0, *header)
+            counts = struct.unpack_from('={}H'.format(self.slots), self.shm,
+                                        offset + OWNER.size)
+            for slot, count in enumerate(counts):
+                if count:
+                    slot_offset = self.slot_offset(slot)
+                    host = list(SLOT.unpack_from(self.shm, slot_offset))
+                    host[0] = max(0, host[0] - count)
+                    SLOT.pack_into(self.shm, slot_offset, *host)
+            logging.warning('fetch budget: reclaimed %d fetches of %d',
+                            inflight, pid)
+        self.shm[offset:offset + self.owner_size] = b'\0' * self.owner_size
+        return inflight
+
+    def reclaim(self, pid):
+        """Releases the fetch slots held by a process that exited
+        Returns the number of fetches that were in flight.
+        """
+        reclaimed = 0
+        with self.lock:
+            for owner in xrange(self.owners):
+                offset = self.owner_offset(owner)
+                if OWNER.unpack_from(self.shm, offset)[0] == pid:
+                    reclaimed += self.clear_owner(owner)
+        return reclaimed
+
+    def host_slot(self, host):
+        return (zlib.crc32(host) & 0xffffffff) % self.slots
+
+    def try_acquire(self, host):
+        """Takes a fetch slot for host
+        Returns None on success or DENIED_GLOBAL/DENIED_HOST
+        """
+        slot = self.host_slot(host)
+        offset = self.slot_offset(slot)
+        now = time.time()
+        with self.lock:
+            self.get_owner()  # a new worker first reclaims dead ones' slots
+            (inflight, tokens, last, acquired, denied_global,
+             denied_host) = HEADER.unpack_from(self.shm, 0)
+            host_inflight, host_tokens, host_last = SLOT.unpack_from(self.shm,
+                                                                     offset)
+            if self.rate:
+                tokens = refill(tokens, last, now, self.rate)
+            if self.hostrate:
+                host_tokens = refill(host_tokens, host_last, now,
+                                     self.hostrate)
+
+            denied = None
+            if ((self.maxclients and inflight >= self.maxclients) or
+                    (self.rate and tokens < 1)):
+                denied = DENIED_GLOBAL
+                denied_global += 1
+            elif ((self.perhost and host_inflight >= self.perhost) or
+                    (self.hostrate and host_tokens < 1)):
+                denied = DENIED_HOST
+                denied_host += 1
+            else:
+                inflight += 1
+                host_inflight += 1
+                acquired += 1
+                if self.rate:
+                    tokens -= 1
+                if self.hostrate:
+                    host_tokens -= 1
+
+            HEADER.pack_into(self.shm, 0, inflight, tokens, now, acquired,
+                             denied_global, denied_host)
+            SLOT.pack_into(self.shm, offset, host_inflight, host_tokens, now)
+            if denied is None:
+                self.count_owner(slot, 1)
+        return denied
+
+    def release(self, host):
+        """Gives back the fetch slot of host and starts waiting fetches
+        """
+        slot = self.host_slot(host)
+        offset = self.slot_offset(slot)
+        with self.lock:
+            header = list(HEADER.unpack_from(self.shm, 0))
+            header[0] = max(0, header[0] - 1)
+            HEADER.pack_into(self.shm, 0, *header)
+            counts = list(SLOT.unpack_from(self.shm, offset))
+            counts[0] = max(0, counts[0] - 1)
+            SLOT.pack_into(self.shm, offset, *counts)
+            self.count_owner(slot, -1)
+        self.drain()
+
+    def submit(self, host, start):
+        """Calls start() once a fetch slot for host has been taken
+        """
+        if not self.waiting and self.try_acquire(host) is None:
+            start()
+            return
+        self.waiting.append((host, start))
+        self.schedule()
+
+    def drain(self):
+        """Starts waiting fetches that fit in the budget, in order
+        Fetches blocked by their host's limit do not hold back others.
+        """
+        self.timeout = None
+        blocked = deque()
+        while self.waiting:
+            host, start = self.waiting.popleft()
+            denied = self.try_acquire(host)
+            if denied is None:
+                start()
+            elif denied == DENIED_GLOBAL:
+                blocked.append((host, start))
+                break
+            else:
+                blocked.append((host, start))
+        blocked.extend(self.waiting)
+        self.waiting = blocked
+        self.schedule()
+
+    def schedule(self):
+        # other workers free slots without telling us: poll while waiting
+        if self.waiting and self.timeout is None:
+            self.timeout = IOLoop.current().call_later(POLL_INTERVAL,
+                                                       self.drain)
+
+    def make_release_handler(self, host, callback):
+        """Wraps a fetch callback so that it first releases host's slot
+        """
+        def release_handler(response):
+            try:
+                self.release(host)
+            except Exception as ex:
+                logging.exception(ex)
+            callback(response)
+        return release_handler
+
+    def stats(self):
+        """Shared counters of the instance and this worker's queue
+        """
+        with self.lock:
+            (inflight, tokens, last, acquired, denied_global,
+             denied_host) = HEADER.unpack_from(self.shm, 0)
+            busy_slots = 0
+            for slot in xrange(self.slots):
+                if SLOT.unpack_from(self.shm, self.slot_offset(slot))[0]:
+                    busy_slots += 1
+            workers = 0
+            for owner in xrange(self.owners):
+                if OWNER.unpack_from(self.shm, self.owner_offset(owner))[0]:
+                    workers += 1
+        return {'in_flight': inflight,
+                'tokens': tokens,
+                'acquired': acquired,
+                'denied_global': denied_global,
+                'denied_host': denied_host,
+                'busy_hosts': busy_slots,
+                'workers': workers,
+                'worker_waiting': len(self.waiting)}
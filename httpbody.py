@@ -0,0 +1,146 @@
+"""
+Bounded, incremental handling of HTTP response bodies
+
+Bodies are requested compressed and decompressed chunk by chunk into a single
+bytearray that is never allowed to grow past a maximum size, so a small
+compressed response cannot expand into an arbitrarily large one (compression
+bombs). The bytearray is handed on as is, without further copies.
+"""
+
+import zlib
+import logging
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+if brotli is not None:
+    ACCEPT_ENCODING = 'gzip, deflate, br'
+else:
+    ACCEPT_ENCODING = 'gzip, deflate'
+
+
+class GzipDecoder(object):
+    """Incremental gzip (or zlib) decoder
+    """
+    def __init__(self, wbits=16 + zlib.MAX_WBITS):
+        self.obj = zlib.decompressobj(wbits)
+
+    def decompress(self, data, max_length):
+        out = self.obj.decompress(data, max_length)
+        # anything left means we stopped at max_length
+        return out, bool(self.obj.unconsumed_tail)
+
+
+class DeflateDecoder(object):
+    """Incremental deflate decoder
+    'deflate' should be zlib wrapped but some servers send raw deflate
+    """
+    def __init__(self):
+        self.obj = zlib.decompressobj()
+        self.first = True
+
+    def decompress(self, data, max_length):
+        if self.first:
+            self.first = False
+            try:
+                return self._decompress(data, max_length)
+            except zlib.error:
+                self.obj = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decompress(data, max_length)
+
+    def _decompress(self, data, max_length):
+        out = self.obj.decompress(data, max_length)
+        return out, bool(self.obj.unconsumed_tail)
+
+
+class BrotliDecoder(object):
+    """Incremental brotli decoder
+    brotli cannot stop at a given output size, so one chunk may expand past
+    max_length before the reader notices and stops.
+    """
+    def __init__(self):
+        self.obj = brotli.Decompressor()
+
+    def decompress(self, data, max_length):
+        out = self.obj.process(data)
+        return out[:max_length], len(out) > max_length
+
+
+class IdentityDecoder(object):
+    def decompress(self, data, max_length):
+        return data[:max_length], len(data) > max_length
+
+
+def get_decoder(content_encoding):
+    """Returns a decoder for a Content-Encoding or None if not supported
+    """
+    content_encoding = (content_encoding or 'identity').strip().lower()
+    if content_encoding in ('identity', ''):
+        return IdentityDecoder()
+    if content_encoding in ('gzip', 'x-gzip'):
+        return GzipDecoder()
+    if content_encoding == 'deflate':
+        return DeflateDecoder()
+    if content_encoding == 'br' and brotli is not None:
+        return BrotliDecoder()
+    return None
+
+
+class BodyReader(object):
+    """Accumulates a (possibly compressed) response body
+    Args:
+        maxsize - maximum number of decompressed bytes kept
+
+    Use header_line and data_received as tornado's header_callback and
+    streaming_callback, or feed set_encoding/data_received directly.
+    Once maxsize is reached the rest of the body is ignored and truncated is
+    set: the head of the page, where canonical urls live, is kept.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.reset()
+
+    def reset(self):
+        self.body = bytearray()
+        self.decoder = IdentityDecoder()
+        self.wire_bytes = 0
+        self.truncated = False
+        self.error = None
+
+    def set_encoding(self, content_encoding):
+        self.decoder = get_decoder(content_encoding)
+        if self.decoder is None:
+            self.error = 'content-encoding'
+
+    def header_line(self, line):
+        """tornado header_callback: a status line starts a new response
+        """
+        if line.startswith('HTTP/'):
+            self.reset()
+            return
+        name, sep, value = line.partition(':')
+        if sep and name.strip().lower() == 'content-encoding':
+            self.set_encoding(value)
+
+    def data_received(self, chunk):
+        """tornado streaming_callback
+        Returns True once the rest of the body is not needed.
+        """
+        self.wire_bytes += len(chunk)
+        if self.truncated or self.error is not None:
+            return True
+
+        remaining = self.maxsize - len(self.body)
+        try:
+            data, capped = self.decoder.decompress(chunk, remaining)
+        except Exception as ex:
+            logging.debug('decompression failed: {}'.format(repr(ex)))
+            self.error = 'decompress'
+            return True
+
+        self.body.extend(data)
+        if capped or len(self.body) >= self.maxsize:
+            self.truncated = True
+        return self.truncated
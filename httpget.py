@@ -3,17 +3,104 @@ HTTP Request for a web page
 """
 
 
+import time
 import logging
 import requests
+from urlparse import urljoin, urlparse
+from email.utils import parsedate_tz, mktime_tz
 from urlhelpers import url_or_error
-from tornado.httpclient import AsyncHTTPClient
+from httpbody import BodyReader, ACCEPT_ENCODING
+from tornado.simple_httpclient import SimpleAsyncHTTPClient, _HTTPConnection
 
 
-def get_web_page(url, timeout):
+MAX_BODY = 2 * 1024 * 1024  # decompressed bytes kept per page
+MAX_WIRE_BODY = 64 * 1024 * 1024  # bytes read of a body nobody stops
+CHUNK_SIZE = 64 * 1024
+MAX_REDIRECTS = 5
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+
+# async fetches started by this process that have not been answered yet
+IN_FLIGHT = 0
+
+# moving average of the time fetches spend queued behind max_clients
+# (waits in a FairQueue or for a budget slot come before and are not in it)
+QUEUE_WAIT = 0.0
+QUEUE_WAIT_UPDATED = 0.0
+QUEUE_WAIT_ALPHA = 0.2
+QUEUE_WAIT_HALFLIFE = 5.0  # seconds, decay when no fetch completes
+
+
+def fetches_in_flight():
+    """Number of async fetches currently outstanding in this process
+    """
+    return IN_FLIGHT
+
+
+def record_queue_wait(wait):
+    """Adds a queue wait time (seconds) to the moving average
+    """
+    global QUEUE_WAIT, QUEUE_WAIT_UPDATED
+    QUEUE_WAIT = fetch_queue_wait()
+    QUEUE_WAIT += QUEUE_WAIT_ALPHA * (wait - QUEUE_WAIT)
+    QUEUE_WAIT_UPDATED = time.time()
+
+
+def fetch_queue_wait():
+    """Recent average time (seconds) fetches waited for a free client
+    Decays towards 0 while no fetch completes so it cannot get stuck high.
+    """
+    idle = time.time() - QUEUE_WAIT_UPDATED
+    return QUEUE_WAIT * 0.5 ** (idle / QUEUE_WAIT_HALFLIFE)
+
+
+def get_queue_wait(response, started):
+    """Time a fetch (a single hop) spent waiting in the client queue
+    before connecting. Returns None if unknown.
+    """
+    elapsed = time.time() - started
+    if response.code == 599 and 'queue' in str(response.error):
+        return elapsed  # timed out without ever leaving the queue
+    if response.request_time is None:
+        return None
+    return max(0.0, elapsed - response.request_time)
+
+
+def log_body(url, reader):
+    """Debug log of the transfered and decompressed sizes of a body
+    """
+    logging.debug('body: %s wire=%d decoded=%d truncated=%s', url,
+                  reader.wire_bytes, len(reader.body), reader.truncated)
+
+
+class StoppingConnection(_HTTPConnection):
+    """Connection that ends a response once its streaming_callback returns
+    True: the response is answered with what was read and the connection
+    closed, instead of reading the rest of the body.
+    """
+    def data_received(self, chunk):
+        if self._should_follow_redirect() or \
+                self.request.streaming_callback is None:
+            super(StoppingConnection, self).data_received(chunk)
+        elif self.request.streaming_callback(chunk) and \
+                self.final_callback is not None:
+            self.finish()
+
+
+class StoppingHTTPClient(SimpleAsyncHTTPClient):
+    """AsyncHTTPClient whose streamed responses stop once the streaming
+    callback returns True (a BodyReader that has all it keeps)
+    """
+    def _connection_class(self):
+        return StoppingConnection
+
+
+def get_web_page(url, timeout, maxsize=MAX_BODY):
     ''' Fetches content at a given URL.
     Requests implementation.
     Args:
         url - unicode string
+        maxsize - maximum decompressed bytes kept (the rest is ignored)
 
     Returns: (data, enc, final_url, None)
               or
@@ -29,7 +116,8 @@ def get_web_page(url, timeout):
     # Download and Processs
     try:
         req = requests.get(url, timeout=timeout, allow_redirects=True,
-                           stream=True)
+                           stream=True,
+                           headers={'Accept-Encoding': ACCEPT_ENCODING})
         req.raise_for_status()
 
         # Get Response URL
@@ -42,56 +130,182 @@ def get_web_page(url, timeout):
         content_type = req.headers.get('content-type')
 
         if content_type and 'text/html' not in content_type:
-            msg = 'content type not supported %s for %s' % (content_type, url)
-            logging.debug(msg)
+            logging.debug('content type not supported %s for %s',
+                          content_type, url)
             return (None, enc, final_url, 'content-type')
 
-        # get data
-        data = req.content
+        # get data: decompress ourselves, at most maxsize bytes
+        reader = BodyReader(maxsize)
+        reader.set_encoding(req.headers.get('content-encoding'))
+        for chunk in req.raw.stream(CHUNK_SIZE, decode_content=False):
+            reader.data_received(chunk)
+            if reader.truncated or reader.error is not None:
+                break
+        req.close()
+        log_body(url, reader)
+
+        if reader.error is not None:
+            return (None, enc, final_url, reader.error)
 
-        return (data, enc, final_url, None)
+        return (reader.body, enc, final_url, None)
 
     except requests.exceptions.Timeout:
-        msg = 'timedout: {}'.format(url)
-        logging.debug(msg)
+        logging.debug('timedout: %s', url)
         reason = 'timeout'
 
     except requests.exceptions.HTTPError:
-        msg = 'download failed: url=%s reason: %d' % (url, req.status_code)
-        logging.debug(msg)
+        logging.debug('download failed: url=%s reason: %d', url,
+                      req.status_code)
         reason = str(req.status_code)
 
     except Exception as ex:
-        msg = 'download failed: url=%s with %s' % (url, repr(ex))
-        logging.debug(msg)
+        logging.debug('download failed: url=%s with %r', url, ex)
         reason = 'download'
 
     return (None, None, None, reason)
 
 
-def make_request_handler(processed_handler):
+def parse_cache_control(value):
+    """Parses a Cache-Control header value into a dict of directives
+    """
+    directives = {}
+    if not value:
+        return directives
+
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '=' in part:
+            key, val = part.split('=', 1)
+            directives[key.strip().lower()] = val.strip().strip('"')
+        else:
+            directives[part.lower()] = None
+
+    return directives
+
+
+def parse_http_date(value):
+    """Returns a timestamp from an HTTP date or None
+    """
+    if not value:
+        return None
+    try:
+        return mktime_tz(parsedate_tz(value))
+    except Exception:
+        return None
+
+
+def get_validators(headers, url=None):
+    """Extracts the cache validators and freshness lifetime of a response
+    Returns a dict with etag, last_modified, max_age (seconds or None if the
+    origin did not specify one), no_store and the url of the response.
+    """
+    directives = parse_cache_control(headers.get('Cache-Control'))
+
+    max_age = None
+    if 'no-cache' in directives:
+        max_age = 0  # may be stored but must always be revalidated
+    else:
+        for key in ('s-maxage', 'max-age'):
+            try:
+                max_age = int(directives[key])
+                break
+            except (KeyError, TypeError, ValueError):
+                pass
+
+    if max_age is None and 'Expires' in headers:
+        expires = parse_http_date(headers.get('Expires'))
+        date = parse_http_date(headers.get('Date')) or time.time()
+        max_age = int(expires - date) if expires is not None else 0
+
+    return {'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'max_age': max_age,
+            'no_store': 'no-store' in directives,
+            'url': url}
+
+
+def get_conditional_headers(entry, url):
+    """Conditional request headers from a cached entry's validators
+    Validators are only sent to the url of the response they came from, not
+    to the other hops of a redirect chain.
+    """
+    headers = {}
+    if entry is None or entry.get('url') != url:
+        return headers
+
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+
+    return headers
+
+
+def make_request_handler(processed_handler, url, reader, started=None,
+                         follow=None, trace=None, queued=None):
     """
     Makes a response handler from a processed_handler
+    url is the originally requested url (before any redirect)
+    reader is the BodyReader the response body was streamed into
+    started is the time the fetch was handed to the HTTP client
+    follow(location) fetches the next hop of a redirect
+    trace is an optional dict collecting request statistics
+    queued is the time the fetch was submitted, its trace's queue_wait
+    includes the time it waited for its turn and a budget slot
     """
     def handle_request(response):
-        url = response.request.url
+        global IN_FLIGHT
+        IN_FLIGHT -= 1
+        final_url = response.effective_url
+
+        wait = None
+        if started is not None:
+            wait = get_queue_wait(response, started)
+            if wait is not None:
+                record_queue_wait(wait)
+
+        if trace is not None:
+            if wait is not None and queued is not None:
+                wait += started - queued
+            add_trace(trace, response, reader, wait)
+
+        location = response.headers.get('Location')
+        if response.code in REDIRECT_CODES and location and follow:
+            follow(urljoin(final_url, location))
+            return
 
-        if response.error:
+        if response.code == 304:
+            # our cached copy is still good: nothing was transfered
+            validators = get_validators(response.headers, final_url)
+            result = (url, None, None, final_url, 'not modified', validators)
+        elif response.code in REDIRECT_CODES:
+            logging.debug('too many redirects: %s', url)
+            result = (url, None, None, None, 'redirects', None)
+        elif response.error:
             reason = str(response.error)
-            logging.debug(reason)
-            result = (url, None, None, None, reason)
+            logging.debug('%s for %s', reason, url)
+            result = (url, None, None, None, reason, None)
         elif 'Content-Type' not in response.headers:
             reason = 'no content-type for {}'.format(url)
             logging.debug(reason)
-            result = (url, None, None, None, reason)
+            result = (url, None, None, None, reason, None)
         elif 'text/html' not in response.headers['Content-Type']:
             reason = 'content type not supported {} for {}'
             reason = reason.format(response.headers['Content-Type'], url)
             logging.debug(reason)
-            result = (url, None, None, response.effective_url, reason)
+            result = (url, None, None, final_url, reason,
+                      get_validators(response.headers, final_url))
+
+        elif reader.error is not None:
+            logging.debug('%s for %s', reader.error, url)
+            result = (url, None, None, final_url, reader.error, None)
 
         else:  # unqualified success as far as this function is concerned
-            result = (url, response.body, 'utf8', response.effective_url, None)
+            log_body(url, reader)
+            result = (url, reader.body, 'utf8', final_url, None,
+                      get_validators(response.headers, final_url))
 
         # logging.debug('req_handler -> sending -> process_handler')
         processed_handler(result)
@@ -99,23 +313,131 @@ def make_request_handler(processed_handler):
     return handle_request
 
 
-def get_web_page_async(url, timeout, maxsize, maxclients, processed_handler):
+def add_trace(trace, response, reader, wait):
+    """Adds the statistics of one fetched hop to a request trace
+    """
+    trace['status'] = response.code
+    trace['wire_bytes'] = trace.get('wire_bytes', 0) + reader.wire_bytes
+    trace['body_bytes'] = len(reader.body)
+    trace['truncated'] = reader.truncated
+    if response.request_time is not None:
+        trace['fetch_time'] = (trace.get('fetch_time', 0.0) +
+                               response.request_time)
+    if wait is not None:
+        trace['queue_wait'] = trace.get('queue_wait', 0.0) + wait
+
+
+def get_web_page_async(url, timeout, maxsize, maxclients, processed_handler,
+                       cached=None, trace=None, budget=None, fetch_queue=None,
+                       priority=None, caller=None, recorder=None,
+                       http_client=None):
     ''' Fetches content at a given URL.
-    Requests implementation.
+    Tornado implementation.
     Args:
         url - unicode string
+        cached - cache entry whose validators are sent as
+                 If-None-Match/If-Modified-Since
+        trace - optional dict that receives the request's statistics
+                (status, wire_bytes, body_bytes, fetch_time, queue_wait,
+                 redirects)
+        budget - optional SharedFetchBudget each hop has to get a slot from
+        fetch_queue - optional FairQueue each hop waits in for its turn,
+                      as the given priority class and caller (a queue
+                      with a budget takes the hop's budget slot itself)
+        recorder - optional TraceRecorder that archives every hop
+        http_client - client to fetch with instead of AsyncHTTPClient
+                      (a crawltrace.ReplayHTTPClient)
 
-    Returns: (data, enc, final_url, None)
+    Redirects are followed here, hop by hop, so that they can be traced.
+
+    Calls processed_handler with
+             (url, data, enc, final_url, None, validators)
               or
-             (None, None, None, Reason) on error.
+             (url, None, None, final_url, 'not modified', validators) on 304
+              or
+             (url, None, None, final_url, Reason, validators) on error.
     '''
+    checked_url = url_or_error(url)
+    if checked_url is None:
+        processed_handler((url, None, None, None, 'url', None))
+        return
+    url = checked_url
+    if fetch_queue is not None and fetch_queue.budget is not None:
+        budget = None
 
-    url = url_or_error(url)
-    if url is None:
-        processed_handler((None, None, None, 'url'))
+    if http_client is None:
+        # the body is streamed: BodyReader keeps maxsize bytes of it and
+        # the client stops reading there, it must not fail larger responses
+        # before they get there
+        http_client = StoppingHTTPClient(max_clients=maxclients,
+                                         max_buffer_size=maxsize,
+                                         max_body_size=max(maxsize,
+                                                           MAX_WIRE_BODY))
+    redirects = []
+    if trace is not None:
+        trace['redirects'] = redirects
+    if recorder is not None and not recorder.sampled():
+        recorder = None
+    started = time.time()
+
+    def fetch(hop_url):
+        global IN_FLIGHT
+        headers = get_conditional_headers(cached, hop_url)
+        headers['Accept-Encoding'] = ACCEPT_ENCODING
+        # the body is decompressed as it streams in and capped at maxsize
+        reader = BodyReader(maxsize)
+        follow = follow_redirect if len(redirects) < MAX_REDIRECTS else None
+        queued = time.time()
+        IN_FLIGHT += 1
+
+        # the recorder sees the wire bytes the reader is fed
+        stream = reader
+        if recorder is not None:
+            stream = recorder.tap(url, hop_url, len(redirects), started,
+                                  headers, reader)
+
+        host = urlparse(hop_url).hostname or ''
+
+        def start():
+            # made now: the client's queue wait is measured from here on
+            handle_request = make_request_handler(processed_handler, url,
+                                                  reader, time.time(), follow,
+                                                  trace, queued)
+            if recorder is not None:
+                handle_request = recorder.make_record_handler(stream,
+                                                              handle_request)
+            if budget is not None:
+                handle_request = budget.make_release_handler(host,
+                                                             handle_request)
+            if fetch_queue is not None:
+                handle_request = fetch_queue.make_release_handler(
+                    priority, caller, handle_request, host)
+            start_fetch(http_client, hop_url, headers, stream, handle_request)
+
+        def take_slot():
+            if budget is None:
+                start()
+            else:
+                budget.submit(host, start)
+
+        if fetch_queue is None:
+            take_slot()
+        else:
+            fetch_queue.submit(take_slot, priority, caller, host)
+
+    def follow_redirect(location):
+        redirects.append(location)
+        fetch(location)
 
-    http_client = AsyncHTTPClient(max_clients=maxclients,
-                                  max_buffer_size=maxsize)
     # Download and Processs
-    handle_request = make_request_handler(processed_handler)
-    http_client.fetch(url, handle_request)
+    fetch(url)
+
+
+def start_fetch(http_client, url, headers, reader, handle_request):
+    """Starts one (hop of a) fetch, streaming the body into reader
+    """
+    http_client.fetch(url, handle_request, headers=headers,
+                      follow_redirects=False,
+                      decompress_response=False,
+                      header_callback=reader.header_line,
+                      streaming_callback=reader.data_received)
@@ -0,0 +1,41 @@
+"""
+Process memory usage, used to instrument requests
+"""
+
+import os
+import resource
+
+
+PAGE_KB = os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+def peak_rss():
+    """Peak resident set size of this process in kB (Linux)
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def current_rss():
+    """Current resident set size of this process in kB or None
+    """
+    try:
+        with open('/proc/self/statm') as fin:
+            return int(fin.read().split()[1]) * PAGE_KB
+    except Exception:
+        return None
+
+
+class RSSProbe(object):
+    """Measures how much a block of (synchronous) work raised peak RSS
+    Peak RSS never goes down, so growth is only seen for requests that set
+    a new high-water mark; rss gives the resident size after the work.
+    """
+    def __init__(self):
+        self.start_peak = peak_rss()
+        self.growth = None
+        self.rss = None
+
+    def stop(self):
+        self.growth = peak_rss() - self.start_peak
+        self.rss = current_rss()
+        return self
@@ -0,0 +1,222 @@
+"""
+Cache of extraction results keyed by the content of the fetched page
+
+Distinct urls (tracking parameters, mirrors, converging redirects) often
+serve byte-identical pages. The fetched bytes and their declared encoding
+are hashed (xxhash if installed, crc32 and adler32 otherwise) and the
+outcome of decoding and parsing them is looked up by that hash, so repeated
+content costs a hash instead of a parse.
+
+The table lives in a shared mmap created before the workers are forked,
+backed by a file when a path is given so that it survives restarts and
+can be shared by unrelated processes (e.g. canonicalbulk next to the
+service), which lock it through path + '.lock'. It is direct mapped: a new
+page replaces whatever was in its slot, which bounds the table's size.
+Slots carry a checksum, so one left half written by a killed process reads
+as a miss. The header records the extraction code's version: a file of
+another version (or size) is replaced with a new one, never changed under
+the processes that still have it mapped.
+"""
+
+import os
+import mmap
+import zlib
+import struct
+from collections import Counter
+from urlparse import urlparse
+from canonicalformat import REASONS, REASON_CODES, to_bytes
+from sharedlock import SharedLock
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+MAGIC = b'CANPAGE2'
+PAGE_SLOTS = 16384
+SLOT_SIZE = 512
+MAX_DOMAINS = 10000
+OTHER_DOMAINS = '(other)'
+
+# magic, extraction version, slots, slot size
+HEADER = struct.Struct('=8sIII')
+# content hash, content length, reason code, canonical url length, checksum
+SLOT = struct.Struct('=QIBHI')
+URL_SIZE = SLOT_SIZE - SLOT.size
+
+
+def content_key(page, enc):
+    """(hash, length) of the page bytes and their declared encoding
+    """
+    enc = enc or ''
+    if xxhash is not None:
+        digest = xxhash.xxh64(page)
+        digest.update(enc)
+        return digest.intdigest(), len(page)
+
+    page = buffer(page)
+    crc = zlib.crc32(enc, zlib.crc32(page)) & 0xffffffff
+    adler = zlib.adler32(enc, zlib.adler32(page)) & 0xffffffff
+    return crc << 32 | adler, len(page)
+
+
+def get_domain(url):
+    """Host of a url without www.
+    """
+    try:
+        host = urlparse(url).hostname or ''
+    except Exception:
+        return ''
+    if host.startswith('www.'):
+        host = host[4:]
+    return host
+
+
+def slot_checksum(digest, length, code, canonical):
+    return zlib.crc32(canonical, zlib.crc32(
+        struct.pack('=QIB', digest, length, code))) & 0xffffffff
+
+
+def map_table(path, size, slots, version):
+    """Maps the table file if it exists and matches, None otherwise
+    """
+    try:
+        fd = os.open(path, os.O_RDWR)
+    except OSError:
+        return None
+    try:
+        if os.fstat(fd).st_size != size:
+            return None
+        table = mmap.mmap(fd, size)
+    finally:
+        os.close(fd)
+
+    if HEADER.unpack_from(table, 0) != (MAGIC, version, slots, SLOT_SIZE):
+        table.close()
+        return None
+    return table
+
+
+def open_table(path, size, slots, version):
+    """Maps the table file, replacing it with an empty one if it does not
+    match
+    The new table is renamed over the old file: processes that have the old
+    one mapped keep it (truncating it under them would crash them with
+    SIGBUS), processes that open the path from now on share the new one.
+    Call with the table's lock held.
+    """
+    table = map_table(path, size, slots, version)
+    if table is not None:
+        return table
+
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, size)
+        table = mmap.mmap(fd, size)
+    finally:
+        os.close(fd)
+    HEADER.pack_into(table, 0, MAGIC, version, slots, SLOT_SIZE)
+    os.rename(tmp, path)
+    return table
+
+
+class PageFeatureCache(object):
+    """Extraction results ('canonical' and its url, 'no attributes',
+    'decode failed') of page contents
+    Args:
+        slots - number of pages kept (SLOT_SIZE bytes each)
+        path - file backing the table, in memory only if None
+        version - version of the extraction code (EXTRACT_VERSION)
+
+    Must be created before forking. Hit rates are counted per worker and per
+    domain.
+    """
+    def __init__(self, slots=PAGE_SLOTS, path=None, version=0):
+        self.slots = slots
+        self.path = path
+        size = HEADER.size + SLOT_SIZE * slots
+        if path:
+            self.lock = SharedLock(path + '.lock')
+            with self.lock:
+                self.table = open_table(path, size, slots, version)
+        else:
+            self.lock = SharedLock()
+            self.table = mmap.mmap(-1, size)
+            HEADER.pack_into(self.table, 0, MAGIC, version, slots, SLOT_SIZE)
+
+        # per worker
+        self.hits = Counter()
+        self.misses = Counter()
+
+    def slot_offset(self, digest):
+        return HEADER.size + SLOT_SIZE * (digest % self.slots)
+
+    def get(self, key, url=None):
+        """(reason, canonical url) stored for a content key, or None
+        url is the page's url, its domain's hit rate is updated.
+        """
+        digest, length = key
+        offset = self.slot_offset(digest)
+        with self.lock:
+            stored, stored_length, reason, url_length, checksum = \
+                SLOT.unpack_from(self.table, offset)
+            found = (stored == digest and stored_length == length and
+                     reason and url_length <= URL_SIZE)
+            if found:
+                start = offset + SLOT.size
+                canonical = self.table[start:start + url_length]
+                found = checksum == slot_checksum(digest, length, reason,
+                                                  canonical)
+
+        self.count(url, found)
+        if not found:
+            return None
+        return REASONS[reason], canonical.decode('utf8') or None
+
+    def put(self, key, reason, canonical=None):
+        """Stores the extraction result of a content key
+        """
+        code = REASON_CODES.get(reason)
+        if not code:
+            return
+        canonical = to_bytes(canonical) or b''
+        if len(canonical) > URL_SIZE:
+            return
+
+        digest, length = key
+        offset = self.slot_offset(digest)
+        checksum = slot_checksum(digest, length, code, canonical)
+        with self.lock:
+            SLOT.pack_into(self.table, offset, digest, length, code,
+                           len(canonical), checksum)
+            start = offset + SLOT.size
+            self.table[start:start + len(canonical)] = canonical
+
+    def count(self, url, hit):
+        domain = get_domain(url) if url else ''
+        if (domain not in self.hits and domain not in self.misses and
+                max(len(self.hits), len(self.misses)) >= MAX_DOMAINS):
+            domain = OTHER_DOMAINS
+        if hit:
+            self.hits[domain] += 1
+        else:
+            self.misses[domain] += 1
+
+    def stats(self, domains=20):
+        """Hit rate of this worker, overall and of its busiest domains
+        """
+        def rate(hits, misses):
+            total = hits + misses
+            return {'hits': hits,
+                    'misses': misses,
+                    'hit_rate': float(hits) / total if total else None}
+
+        lookups = self.hits + self.misses
+        busiest = lookups.most_common(domains)
+        stats = rate(sum(self.hits.values()), sum(self.misses.values()))
+        stats['slots'] = self.slots
+        stats['domains'] = dict((domain, rate(self.hits[domain],
+                                              self.misses[domain]))
+                                for domain, _ in busiest)
+        return stats
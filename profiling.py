@@ -0,0 +1,116 @@
+"""
+Opt-in profiling of a running worker
+
+SamplingProfiler samples the worker's stack on SIGPROF (CPU time), so it
+only sees where CPU is actually spent (html5lib, UnicodeDammit, rfc3987,
+public suffix lookups, ...). Its output is in the collapsed stack format read by
+flamegraph.pl and speedscope.
+
+SlowRequests keeps the last slow requests of the worker, with the url,
+stage timings and page size of each.
+"""
+
+import os
+import time
+import signal
+from collections import deque, defaultdict
+
+
+PROFILE_INTERVAL = 0.005  # seconds of CPU time between samples
+PROFILE_MAX_DURATION = 300
+MAX_DEPTH = 128
+
+SLOW_THRESHOLD = 2.0
+SLOW_SIZE = 100
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return '{}:{}'.format(os.path.basename(code.co_filename), code.co_name)
+
+
+class SamplingProfiler(object):
+    """Statistical profiler driven by an ITIMER_PROF timer
+    """
+    def __init__(self):
+        self.stacks = defaultdict(int)
+        self.samples = 0
+        self.running = False
+        self.started = None
+        self.stopped = None
+        self.interval = PROFILE_INTERVAL
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None and len(stack) < MAX_DEPTH:
+            stack.append(frame_name(frame))
+            frame = frame.f_back
+        stack.reverse()
+        self.stacks[';'.join(stack)] += 1
+        self.samples += 1
+
+    def start(self, interval=PROFILE_INTERVAL):
+        """Starts sampling, clearing previous samples
+        """
+        self.stop()
+        self.stacks = defaultdict(int)
+        self.samples = 0
+        self.interval = interval
+        self.started = time.time()
+        self.stopped = None
+        signal.signal(signal.SIGPROF, self.sample)
+        # restart system calls the signal interrupts instead of failing them
+        # with EINTR (python 2 does not retry them)
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, interval, interval)
+        self.running = True
+
+    def stop(self):
+        if not self.running:
+            return
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)
+        self.running = False
+        self.stopped = time.time()
+
+    def collapsed(self):
+        """Samples as 'frame;frame;frame count' lines (flame graph input)
+        """
+        lines = ['{} {}'.format(stack, count)
+                 for stack, count in self.stacks.iteritems()]
+        lines.sort()
+        return '\n'.join(lines) + '\n'
+
+    def status(self):
+        return {'running': self.running,
+                'interval': self.interval,
+                'samples': self.samples,
+                'started': self.started,
+                'stopped': self.stopped}
+
+
+class SlowRequests(object):
+    """Last slow requests of this worker
+    Args:
+        threshold - seconds past which a request is recorded
+        size - number of requests kept
+    """
+    def __init__(self, threshold=SLOW_THRESHOLD, size=SLOW_SIZE):
+        self.threshold = threshold
+        self.requests = deque(maxlen=size)
+
+    def add(self, trace, result):
+        """Records a finished request if it was slow
+        """
+        total = trace.get('total')
+        if total is None or total < self.threshold:
+            return
+        record = dict(trace)
+        record['reason'] = result.get('reason')
+        record['method'] = result.get('method')
+        self.requests.append(record)
+
+    def list(self):
+        """Slow requests, most recent first
+        """
+        return list(reversed(self.requests))
@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Offline public suffix lookups (replaces tldextract)
+
+The public suffix list snapshot bundled with the service
+(public_suffix_list.dat) is compiled into public_suffix.bin: an open
+addressing hash table of the rules and of their parents (crc32 keyed, linear
+probing) followed by the rule strings. Parents are flagged so that lookups,
+which go from the last label leftwards, stop as soon as no longer rule can
+match. The table is used in place through a read-only mmap, so it
+loads in well under a millisecond, needs no network and its pages are shared
+by all workers.
+
+Update the snapshot from a local copy of the list with:
+    python publicsuffix.py update path/to/public_suffix_list.dat
+"""
+
+from __future__ import print_function
+import os
+import re
+import mmap
+import time
+import zlib
+import shutil
+import struct
+import hashlib
+import argparse
+from collections import namedtuple
+
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SNAPSHOT = os.path.join(BASE_DIR, 'public_suffix_list.dat')
+TABLE = os.path.join(BASE_DIR, 'public_suffix.bin')
+
+MAGIC = b'CANPSL01'
+# magic, version, sha1 of the source list, keys, slots, bytes of strings
+HEADER = struct.Struct('=8s32s20sIII')
+# crc32 of the key, offset and length of the key in the strings, flags
+SLOT = struct.Struct('=IIHBx')
+
+# rule kinds; private domain rules are shifted by PRIVATE_SHIFT
+RULE = 1
+WILDCARD = 2
+EXCEPTION = 4
+PRIVATE_SHIFT = 4
+KINDS = RULE | WILDCARD | EXCEPTION
+# longer rules end with this key
+PARENT = 0x80
+
+SCHEME_RE = re.compile(r'^([a-zA-Z][a-zA-Z0-9+.-]*:)?//')
+IPV4_RE = re.compile(r'^(\d{1,3}\.){3}\d{1,3}$')
+
+
+class ExtractResult(namedtuple('ExtractResult', 'subdomain domain suffix')):
+    """Same fields as tldextract's result
+    """
+    __slots__ = ()
+
+    @property
+    def registered_domain(self):
+        if self.domain and self.suffix:
+            return self.domain + '.' + self.suffix
+        return ''
+
+
+def parse_rules(lines):
+    """Yields (key, flags) of the rules of a public suffix list
+    Keys are utf8 and, for internationalized rules, also punycode.
+    """
+    private = False
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf8')
+        line = line.strip()
+        if '===BEGIN PRIVATE DOMAINS===' in line:
+            private = True
+        if not line or line.startswith('//'):
+            continue
+
+        rule = line.split()[0].lower()
+        if rule.startswith('!'):
+            rule, kind = rule[1:], EXCEPTION
+        elif rule.startswith('*.'):
+            rule, kind = rule[2:], WILDCARD
+        else:
+            kind = RULE
+        if private:
+            kind <<= PRIVATE_SHIFT
+
+        yield rule.encode('utf8'), kind
+        try:
+            ascii_rule = rule.encode('idna')
+        except UnicodeError:
+            continue
+        if ascii_rule != rule.encode('utf8'):
+            yield ascii_rule, kind
+
+
+def get_version(source, mtime=None):
+    """VERSION comment of a list, or the date of the file
+    """
+    for line in source.splitlines()[:50]:
+        if line.startswith('// VERSION:'):
+            return line.split(':', 1)[1].strip()
+    return time.strftime('%Y-%m-%d', time.gmtime(mtime))
+
+
+def compile_table(source, version=None, mtime=None):
+    """Compiled table (bytes) of a public suffix list's text
+    """
+    rules = {}
+    for key, kind in parse_rules(source.splitlines()):
+        rules[key] = rules.get(key, 0) | kind
+        dot = key.find(b'.')
+        while dot >= 0:
+            parent = key[dot + 1:]
+            rules[parent] = rules.get(parent, 0) | PARENT
+            dot = key.find(b'.', dot + 1)
+
+    slots = 1
+    while slots < 2 * len(rules):
+        slots *= 2
+    mask = slots - 1
+
+    table = bytearray(SLOT.size * slots)
+    strings = bytearray()
+    for key in sorted(rules):
+        digest = zlib.crc32(key) & 0xffffffff
+        index = digest & mask
+        while SLOT.unpack_from(table, index * SLOT.size)[2]:
+            index = (index + 1) & mask
+        SLOT.pack_into(table, index * SLOT.size, digest, len(strings),
+                       len(key), rules[key])
+        strings.extend(key)
+
+    version = version or get_version(source, mtime)
+    header = HEADER.pack(MAGIC, version.encode('utf8'),
+                         hashlib.sha1(source).digest(), len(rules), slots,
+                         len(strings))
+    return bytes(header + table + strings)
+
+
+def write_table(source_path, table_path, version=None):
+    """Compiles a public suffix list file, replacing table_path atomically
+    (running workers keep their mapping of the old file)
+    """
+    with open(source_path, 'rb') as fin:
+        data = compile_table(fin.read(), version,
+                             os.path.getmtime(source_path))
+    tmp_path = table_path + '.tmp'
+    with open(tmp_path, 'wb') as fout:
+        fout.write(data)
+    os.rename(tmp_path, table_path)
+
+
+class SuffixTable(object):
+    """Read-only view of a compiled table
+    """
+    def __init__(self, path=TABLE):
+        with open(path, 'rb') as fin:
+            self.data = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, sha1, self.keys, self.slots,
+         size) = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError('not a public suffix table: {}'.format(path))
+        self.version = version.rstrip(b'\0').decode('utf8')
+        self.sha1 = sha1.encode('hex')
+        self.mask = self.slots - 1
+        self.strings = HEADER.size + SLOT.size * self.slots
+
+    def lookup(self, key):
+        """Flags of a (lowercase, utf8) suffix, 0 if it is not in the list
+        """
+        digest = zlib.crc32(key) & 0xffffffff
+        index = digest & self.mask
+        data = self.data
+        while True:
+            stored, offset, length, flags = SLOT.unpack_from(
+                data, HEADER.size + index * SLOT.size)
+            if not length:
+                return 0
+            if stored == digest and length == len(key):
+                start = self.strings + offset
+                if data[start:start + length] == key:
+                    return flags
+            index = (index + 1) & self.mask
+
+    def info(self):
+        return {'version': self.version,
+                'sha1': self.sha1,
+                'keys': self.keys,
+                'slots': self.slots,
+                'bytes': len(self.data)}
+
+
+def get_host(url):
+    """Host of a url (or of a bare host name), without port or credentials
+    """
+    netloc = url.strip()
+    if '//' in netloc:
+        netloc = SCHEME_RE.sub('', netloc)
+    netloc = netloc.partition('/')[0].partition('?')[0].partition('#')[0]
+    return netloc.split('@')[-1].partition(':')[0].strip().rstrip('.')
+
+
+class SuffixExtractor(object):
+    """Splits urls into subdomain, domain and public suffix (tldextract API)
+    Args:
+        table - SuffixTable
+        include_private - also use the private domains section of the list
+                          (tldextract does not by default)
+    """
+    def __init__(self, table, include_private=False):
+        self.table = table
+        self.include_private = include_private
+
+    def suffix_labels(self, host):
+        """Number of labels of the public suffix of host
+        """
+        key = host.lower()
+        if isinstance(key, unicode):
+            key = key.encode('utf8')
+        lookup = self.table.lookup
+        labels = 0
+        best = 0
+        end = len(key)
+        while True:
+            dot = key.rfind(b'.', 0, end)
+            labels += 1
+            flags = lookup(key[dot + 1:])
+            if not flags:
+                break
+            kinds = flags & KINDS
+            if self.include_private:
+                kinds |= flags >> PRIVATE_SHIFT & KINDS
+
+            if kinds & EXCEPTION:
+                best = labels - 1
+                break
+            if kinds & RULE:
+                best = labels
+            if kinds & WILDCARD and dot >= 0:
+                best = labels + 1
+            if dot < 0 or not flags & PARENT:
+                break
+            end = dot
+        return best
+
+    def __call__(self, url):
+        host = get_host(url)
+        if not host or host[-1].isdigit() and IPV4_RE.match(host):
+            return ExtractResult('', host, '')
+
+        labels = host.split('.')
+        start = len(labels) - self.suffix_labels(host)
+        return ExtractResult('.'.join(labels[:max(start - 1, 0)]),
+                             labels[start - 1] if start else '',
+                             '.'.join(labels[start:]))
+
+
+def benchmark(extract, hosts, repeat=10):
+    started = time.time()
+    for _ in xrange(repeat):
+        for host in hosts:
+            extract(host)
+    return len(hosts) * repeat / (time.time() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Public suffix table.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    update = subparsers.add_parser(
+        'update', help='replace the bundled snapshot with a local list file')
+    update.add_argument('source', help='public_suffix_list.dat')
+    update.add_argument('--version', help='defaults to the list\'s VERSION '
+                                          'comment or today\'s date')
+
+    info = subparsers.add_parser('info', help='describe a compiled table')
+    info.add_argument('--table', default=TABLE)
+
+    extract = subparsers.add_parser('extract', help='split hosts or urls')
+    extract.add_argument('urls', nargs='+')
+    extract.add_argument('--table', default=TABLE)
+    extract.add_argument('--private', action='store_true',
+                         help='include private domains')
+    extract.add_argument('--benchmark', action='store_true',
+                         help='time lookups of the given urls')
+    args = parser.parse_args()
+
+    if args.command == 'update':
+        if os.path.abspath(args.source) != SNAPSHOT:
+            shutil.copy2(args.source, SNAPSHOT)
+        write_table(SNAPSHOT, TABLE, args.version)
+        print(SuffixTable(TABLE).info())
+        return
+
+    started = time.time()
+    table = SuffixTable(args.table)
+    loaded = time.time() - started
+
+    if args.command == 'info':
+        print(dict(table.info(), load_time=loaded))
+        return
+
+    extractor = SuffixExtractor(table, args.private)
+    for url in args.urls:
+        result = extractor(url.decode('utf8'))
+        line = u'{} {} {}'.format(url.decode('utf8'), tuple(result),
+                                  result.registered_domain)
+        print(line.encode('utf8'))
+    if args.benchmark:
+        print('{:.0f} lookups/s'.format(benchmark(extractor, args.urls,
+                                                  100000 // len(args.urls))))
+
+
+if __name__ == '__main__':
+    main()
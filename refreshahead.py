@@ -0,0 +1,156 @@
+"""
+Background refresh-ahead of hot URLs
+
+Request frequency per normalized url is tracked with a count-min sketch so
+memory stays bounded no matter how many distinct urls are seen. Cached
+entries of hot urls that are about to expire are queued and re-resolved in
+the background, but only while the worker has spare fetch capacity.
+"""
+
+import time
+import logging
+from array import array
+from collections import deque
+from tornado.ioloop import PeriodicCallback
+from httpget import fetches_in_flight
+
+
+SKETCH_WIDTH = 2 ** 16
+SKETCH_DEPTH = 4
+MAX_COUNT = 2 ** 32 - 1
+DECAY_SLICE = 8192  # counters halved per refresh queue check
+
+
+class CountMinSketch(object):
+    """Approximate frequency counter in width * depth 32 bit cells
+    Estimates never undercount, they may overcount on collisions.
+    """
+    def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH):
+        self.width = width
+        self.depth = depth
+        self.table = array('I', [0]) * (width * depth)
+
+    def _indexes(self, key):
+        # double hashing: row i uses h1 + i * h2
+        h = hash(key)
+        h1 = h & 0xffffffff
+        h2 = ((h >> 32) & 0xffffffff) | 1
+        return [row * self.width + (h1 + row * h2) % self.width
+                for row in xrange(self.depth)]
+
+    def add(self, key):
+        """Counts one occurrence of key and returns its new estimate
+        Uses conservative update: only the minimal cells are incremented.
+        """
+        indexes = self._indexes(key)
+        table = self.table
+        estimate = min(table[i] for i in indexes)
+        if estimate < MAX_COUNT:
+            estimate += 1
+            for i in indexes:
+                if table[i] < estimate:
+                    table[i] = estimate
+        return estimate
+
+    def estimate(self, key):
+        """Estimated number of occurrences of key
+        """
+        return min(self.table[i] for i in self._indexes(key))
+
+    def decay(self, start=0, stop=None):
+        """Halves the counters in [start, stop) (all of them by default) so
+        old traffic stops counting as hot
+        """
+        table = self.table
+        table[start:stop] = array('I', [count >> 1
+                                        for count in table[start:stop]])
+
+
+class RefreshAhead(object):
+    """Re-resolves hot cache entries shortly before they expire
+    Args:
+        threshold - requests (since the last decay) that make an url hot
+        window - seconds before expiry at which an entry may be refreshed
+        spare - fraction of maxclients that may be busy for refreshes to run
+        interval - milliseconds between refresh queue checks
+        decay - seconds between halvings of the frequency counters (done a
+                slice per check, not to hold up the IOLoop)
+        maxpending - maximum number of queued refreshes
+    """
+    def __init__(self, threshold=10, window=60, spare=0.5, interval=500,
+                 decay=300, maxpending=1000, width=SKETCH_WIDTH,
+                 depth=SKETCH_DEPTH):
+        self.threshold = threshold
+        self.window = window
+        self.spare = spare
+        self.interval = interval
+        self.decay_interval = decay
+        self.maxpending = maxpending
+        self.sketch = CountMinSketch(width, depth)
+        self.queue = deque()
+        self.pending = set()
+        self.resolve = None
+        self.maxclients = 0
+        self.last_decay = time.time()
+        self.decay_next = None  # first counter of the halving in progress
+        self.periodic = None
+
+    def record(self, url, entry):
+        """Counts a request for url and queues a refresh of its cache entry
+        if the url is hot and the entry is about to expire.
+        """
+        count = self.sketch.add(url)
+        if entry is None or count < self.threshold or url in self.pending:
+            return
+
+        remaining = entry['expires'] - time.time()
+        if remaining <= 0 or remaining > self.window:
+            return  # expired ones get fetched by the request itself
+
+        if len(self.pending) >= self.maxpending:
+            return
+
+        self.pending.add(url)
+        self.queue.append(url)
+
+    def make_done_handler(self, url):
+        """Returns a handler that clears a finished refresh
+        """
+        def done(result):
+            self.pending.discard(url)
+            logging.debug('refreshed ahead: %s', url)
+        return done
+
+    def run(self):
+        """Starts queued refreshes using only spare fetch capacity
+        """
+        now = time.time()
+        if self.decay_next is None and \
+                now - self.last_decay >= self.decay_interval:
+            self.decay_next = 0
+            self.last_decay = now
+        if self.decay_next is not None:
+            stop = self.decay_next + DECAY_SLICE
+            self.sketch.decay(self.decay_next, stop)
+            self.decay_next = stop if stop < len(self.sketch.table) else None
+
+        available = int(self.maxclients * self.spare) - fetches_in_flight()
+        while available > 0 and self.queue:
+            url = self.queue.popleft()
+            self.resolve(url, self.make_done_handler(url))
+            available -= 1
+
+    def start(self, resolve, maxclients):
+        """Starts checking the refresh queue on the current IOLoop
+        resolve(url, handler) must re-resolve url bypassing fresh cache entries
+        Must be called in each worker (after forking).
+        """
+        self.resolve = resolve
+        self.maxclients = maxclients
+        self.periodic = PeriodicCallback(self.run, self.interval)
+        self.periodic.start()
+
+    def stop(self):
+        if self.periodic is not None:
+            self.periodic.stop()
+            self.periodic = None
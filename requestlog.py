@@ -0,0 +1,191 @@
+"""
+Structured, sampled, asynchronous request logging
+
+Each request produces one JSON record (url, method, reason, timings, bytes,
+redirect hops). Records, like the rest of the worker's log, are put on a
+queue by the request handling code and written to disk by a thread, so a
+slow disk never blocks the IOLoop. Each forked worker writes its own file.
+"""
+
+import os
+import json
+import time
+import random
+import logging
+import threading
+import Queue
+
+
+REQUEST_LOGGER = 'canonical.requests'
+QUEUE_SIZE = 10000
+
+# reasons that mean the service did its job, subject to sampling
+SUCCESS_REASONS = frozenset(['canonical', 'no attributes', 'not in lists',
+                             'not in whitelist'])
+
+
+class QueueHandler(logging.Handler):
+    """Puts log records on a queue, never blocks
+    Records are dropped (and counted) if the queue is full.
+    """
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def prepare(self, record):
+        # merge args (and the traceback) now, they may change later
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    """Thread that writes queued records with the given handlers
+    """
+    def __init__(self, queue, handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run,
+                                       name='log-listener')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+
+class AppendHandler(logging.Handler):
+    """Writes each record with a single write on an O_APPEND descriptor
+    Records are never interleaved with those of another process appending
+    to the same file (e.g. the worker it replaces, still draining).
+    """
+    def __init__(self, path):
+        logging.Handler.__init__(self)
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def emit(self, record):
+        try:
+            line = self.format(record)
+            if isinstance(line, unicode):
+                line = line.encode('utf8')
+            os.write(self.fd, line + b'\n')
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        logging.Handler.close(self)
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line from the record's data attribute
+    """
+    def format(self, record):
+        data = getattr(record, 'data', None)
+        if data is None:
+            data = {'message': record.getMessage()}
+        data = dict(data, time=record.created, pid=record.process)
+        return json.dumps(data, separators=(',', ':'), default=repr)
+
+
+def start_queue_logging(logger, queuesize=QUEUE_SIZE):
+    """Moves a logger's handlers behind a queue drained by a thread
+    Returns the QueueListener.
+    """
+    queue = Queue.Queue(queuesize)
+    listener = QueueListener(queue, logger.handlers[:])
+    logger.handlers = [QueueHandler(queue)]
+    listener.start()
+    return listener
+
+
+def new_trace(url):
+    """Starts the statistics of a request
+    """
+    return {'url': url, 'start': time.time()}
+
+
+class RequestLog(object):
+    """Per-worker JSON request log
+    Args:
+        path - log file; {worker} and {pid} are replaced in each worker
+        sample - fraction of successful requests that are logged
+                 (failures are always logged)
+    """
+    def __init__(self, path, sample=1.0, queuesize=QUEUE_SIZE):
+        self.path = path
+        self.sample = sample
+        self.queuesize = queuesize
+        self.logger = logging.getLogger(REQUEST_LOGGER)
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.listeners = []
+
+    def start(self, worker):
+        """Opens this worker's log and starts the writer threads
+        Must be called in each worker (after forking): threads do not
+        survive a fork.
+        """
+        path = self.path.format(worker=worker, pid=os.getpid())
+        handler = AppendHandler(path)
+        handler.setFormatter(JSONFormatter())
+        self.logger.handlers = [handler]
+        self.listeners.append(start_queue_logging(self.logger,
+                                                  self.queuesize))
+
+        # the plain text log also goes through a queue
+        root = logging.getLogger()
+        if root.handlers:
+            self.listeners.append(start_queue_logging(root, self.queuesize))
+
+    def stop(self):
+        for listener in self.listeners:
+            listener.stop()
+        self.listeners = []
+
+    def log(self, trace, result):
+        """Logs a finished request
+        """
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+
+        if (result.get('reason') in SUCCESS_REASONS and
+                self.sample < 1.0 and random.random() >= self.sample):
+            return
+
+        record = dict(trace)
+        record.setdefault('total', time.time() - trace['start'])
+        record['method'] = result.get('method')
+        record['reason'] = result.get('reason')
+        record['url_retrieved'] = result.get('url_retrieved')
+        self.logger.info('request', extra={'data': record})
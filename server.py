@@ -4,31 +4,86 @@ Tornado server
 
 import tornado
 import logging
+import os
+import time
+import signal
 from tornado.ioloop import IOLoop
+from tornado.process import task_id
+from tornado.netutil import bind_sockets
 from tornado.httpserver import HTTPServer
-from tornado.web import RequestHandler, MissingArgumentError
+from tornado.web import RequestHandler, MissingArgumentError, HTTPError
 from canonicalurl import get_canonical_url_async
+from admission import OVERLOADED
+from requestlog import new_trace
+from httpget import fetches_in_flight
+from profiling import SamplingProfiler, PROFILE_INTERVAL, PROFILE_MAX_DURATION
+from canonicalformat import FORMATS, negotiate
+
+
+DRAIN_TIMEOUT = 30
+DRAIN_POLL = 0.1
 
 
 class MainHandler(RequestHandler):
-    def initialize(self, whitelist, expandlist, extract, timeout, maxsize,
-                   maxclients):
-        self.whitelist = whitelist
-        self.expandlist = expandlist
-        self.extract = extract
-        self.timeout = timeout
-        self.maxsize = maxsize
-        self.maxclients = maxclients
+    def initialize(self, ctx):
+        self.ctx = ctx
+        self.format = None
+
+    def get_format(self):
+        """Response format from the format argument or the Accept header
+        Answers 406 and returns None if the requested format is unknown.
+        """
+        fmt = negotiate(self.get_query_argument('format', None),
+                        self.request.headers.get('Accept'))
+        if fmt is None:
+            self.set_status(406)
+            self.finish({'error': 'unknown format',
+                         'formats': [f.name for f in FORMATS]})
+        return fmt
+
+    def resolve(self, url, handler):
+        """Resolves url, calls handler(trace, result)
+        """
+        ctx = self.ctx
+        trace = None
+        if ctx.request_log is not None or ctx.slow is not None:
+            trace = new_trace(url)
+        priority = caller = None
+        if ctx.fetch_queue is not None:
+            priority, caller = ctx.fetch_queue.classify(self.request.headers,
+                                                        self.request.remote_ip)
+
+        def canonical_handler(data):
+            self.record(trace, data)
+            handler(trace, data)
+
+        get_canonical_url_async(url, ctx, canonical_handler, trace=trace,
+                                priority=priority, caller=caller)
+
+    def record(self, trace, data):
+        """Request log and slow request capture of a finished url
+        """
+        if trace is None:
+            return
+        trace['total'] = time.time() - trace['start']
+        if self.ctx.request_log is not None:
+            self.ctx.request_log.log(trace, data)
+        if self.ctx.slow is not None:
+            self.ctx.slow.add(trace, data)
 
     @tornado.web.asynchronous
     def get_canonical(self, url):
-        get_canonical_url_async(url, self.whitelist, self.expandlist,
-                                self.extract, self.timeout, self.maxsize,
-                                self.maxclients, self.write_data)
+        self.resolve(url, self.write_data)
 
-    def write_data(self, data):
+    def write_data(self, trace, data):
+        # shed: fast 503 so clients back off instead of piling up
+        if data.get('reason') == OVERLOADED:
+            self.set_status(503)
+            self.set_header('Retry-After',
+                            str(self.ctx.admission.retryafter))
         try:
-            self.write(data)
+            self.set_header('Content-Type', self.format.content_type)
+            self.write(self.format.encode(data))
         except Exception as ex:
             print(data)
             logging.exception(ex)
@@ -38,6 +93,9 @@ class MainHandler(RequestHandler):
     def get(self):
         try:
             url = self.get_query_argument('url')
+            self.format = self.get_format()
+            if self.format is None:
+                return
             self.get_canonical(url)
         except MissingArgumentError:
             self.write({'error': 'no url query parameter'})
@@ -45,22 +103,255 @@ class MainHandler(RequestHandler):
             self.write({'error': str(e)})
 
 
-def make_app(whitelist, expandlist, extract, timeout, maxsize, maxclients):
-    d = {'whitelist': whitelist,
-         'expandlist': expandlist,
-         'extract': extract,
-         'timeout': timeout,
-         'maxsize': maxsize,
-         'maxclients': maxclients}
+class BatchHandler(MainHandler):
+    """POST /batch - resolves the urls in the body, one per line
+    Results are streamed in the order of the urls, in the negotiated format
+    (ndjson or a binary format let clients decode them as they arrive).
+    Shed urls get reason 'overloaded' and may be retried by the client.
+    """
+    def initialize(self, ctx):
+        super(BatchHandler, self).initialize(ctx)
+        self.results = []
+        self.next = 0
+        self.closed = False
+
+    @tornado.web.asynchronous
+    def post(self):
+        self.format = self.get_format()
+        if self.format is None:
+            return
+
+        urls = [line.strip() for line in self.request.body.splitlines()]
+        urls = [url for url in urls if url]
+        if len(urls) > self.ctx.maxbatch:
+            self.set_status(413)
+            self.finish({'error': 'more than {} urls'.format(
+                self.ctx.maxbatch)})
+            return
+
+        self.set_header('Content-Type', self.format.content_type)
+        self.write(self.format.header())
+        self.results = [None] * len(urls)
+        if not urls:
+            self.finish(self.format.footer())
+            return
+
+        for index, url in enumerate(urls):
+            self.resolve(url, self.make_result_handler(index))
+
+    def make_result_handler(self, index):
+        def result_handler(trace, data):
+            self.results[index] = data
+            self.write_ready()
+        return result_handler
+
+    def write_ready(self):
+        """Writes the results that are next in order
+        """
+        if self.closed:
+            return
+        start = self.next
+        while (self.next < len(self.results) and
+               self.results[self.next] is not None):
+            self.write(self.format.encode_item(self.results[self.next],
+                                               self.next))
+            self.results[self.next] = True  # written, free the result
+            self.next += 1
+        if self.next == len(self.results):
+            self.finish(self.format.footer())
+        elif self.next > start:
+            self.flush()
+
+    def on_connection_close(self):
+        self.closed = True
+
+
+class StatsHandler(RequestHandler):
+    """Counters of this worker and the instance wide fetch budget
+    """
+    def initialize(self, ctx, worker=None):
+        self.ctx = ctx
+        self.worker = worker if worker is not None else task_id()
+
+    def get(self):
+        ctx = self.ctx
+        stats = {'pid': os.getpid(),
+                 'worker': self.worker,
+                 'in_flight': fetches_in_flight()}
+        if ctx.cache is not None:
+            stats['cache'] = len(ctx.cache)
+        if ctx.admission is not None:
+            stats['admission'] = ctx.admission.stats()
+        if ctx.budget is not None:
+            stats['budget'] = ctx.budget.stats()
+        if ctx.features is not None:
+            stats['pages'] = ctx.features.stats()
+        if ctx.fetch_queue is not None:
+            stats['queue'] = ctx.fetch_queue.stats()
+        self.write(stats)
+
+
+class ProfileHandler(RequestHandler):
+    """Sampling profiler of this worker
+    POST /debug/profile/start[?interval=seconds&duration=seconds]
+    POST /debug/profile/stop
+    GET /debug/profile - collapsed stacks (flame graph input)
+    GET /debug/profile/status
+    """
+    def initialize(self, profiler):
+        self.profiler = profiler
+
+    def post(self, action):
+        if action == 'start':
+            interval = float(self.get_query_argument('interval',
+                                                     PROFILE_INTERVAL))
+            duration = float(self.get_query_argument('duration',
+                                                     PROFILE_MAX_DURATION))
+            duration = min(duration, PROFILE_MAX_DURATION)
+            self.profiler.start(interval)
+            started = self.profiler.started
+
+            # never leave a forgotten profiler running
+            def stop():
+                if self.profiler.started == started:
+                    self.profiler.stop()
+            IOLoop.current().call_later(duration, stop)
+        elif action == 'stop':
+            self.profiler.stop()
+        else:
+            raise HTTPError(404)
+        self.write(dict(self.profiler.status(), pid=os.getpid()))
+
+    def get(self, action):
+        if action == 'status':
+            self.write(dict(self.profiler.status(), pid=os.getpid()))
+            return
+        if action:
+            raise HTTPError(404)
+        self.set_header('Content-Type', 'text/plain')
+        self.write(self.profiler.collapsed())
 
+
+class SlowHandler(RequestHandler):
+    """GET /debug/slow - last slow requests of this worker
+    """
+    def initialize(self, slow):
+        self.slow = slow
+
+    def get(self):
+        self.write({'pid': os.getpid(),
+                    'threshold': self.slow.threshold,
+                    'requests': self.slow.list()})
+
+
+def make_app(ctx):
+    args = {'ctx': ctx}
+    handlers = [
+        (r"/", MainHandler, args),
+        (r"/batch", BatchHandler, args),
+        (r"/stats", StatsHandler, args),
+    ]
+
+    return tornado.web.Application(handlers)
+
+
+def make_admin_app(worker, ctx):
+    """Debug endpoints of one worker
+    The public port is shared by all workers (any of them may answer), so
+    these are served on a port of their own by each worker.
+    """
     return tornado.web.Application([
-        (r"/", MainHandler, d),
+        (r"/stats", StatsHandler, {'ctx': ctx, 'worker': worker}),
+        (r"/debug/slow", SlowHandler, {'slow': ctx.slow}),
+        (r"/debug/profile/?(\w*)", ProfileHandler,
+         {'profiler': SamplingProfiler()}),
     ])
 
 
-def serve(port, whitelist, expandlist, extract, timeout, maxsize, maxclients):
-    ap = make_app(whitelist, expandlist, extract, timeout, maxsize, maxclients)
+def start_admin(worker, ctx):
+    """Serves a worker's debug endpoints on 127.0.0.1:adminport + worker
+    Returns the HTTPServer, None if the debug endpoints are off.
+    """
+    if ctx.slow is None or not ctx.adminport:
+        return None
+    port = ctx.adminport + worker
+    server = HTTPServer(make_admin_app(worker, ctx))
+    # a replacement worker binds the port while the old one drains
+    server.add_sockets(bind_sockets(port, address='127.0.0.1',
+                                    reuse_port=True))
+    logging.info('worker %d admin port %d', worker, port)
+    return server
+
+
+def start_worker(worker, ctx):
+    """Starts what each worker runs besides the server (after forking)
+    """
+    # log and trace writer threads have to be started in each worker
+    ctx.start(worker)
+
+    # refresh-ahead runs in each worker, it needs the cache to do anything
+    if ctx.refresher is not None and ctx.cache is not None:
+        # background work: lowest priority class
+        priority = None
+        if ctx.fetch_queue is not None:
+            priority = ctx.fetch_queue.lowest()
+
+        def resolve(url, handler):
+            get_canonical_url_async(url, ctx, handler, refresh=True,
+                                    priority=priority, caller='refresh')
+        ctx.refresher.start(resolve, ctx.maxclients)
+
+
+def serve(port, ctx):
+    ap = make_app(ctx)
     server = HTTPServer(ap)
     server.bind(port)
     server.start(0)  # Forks multiple sub-processes
+
+    worker = task_id()
+    worker = worker if worker is not None else 0
+    start_worker(worker, ctx)
+    start_admin(worker, ctx)
+
     IOLoop.current().start()
+
+
+def serve_worker(worker, ready, port, ctx, drain_timeout=DRAIN_TIMEOUT):
+    """Runs one supervised worker on its own SO_REUSEPORT socket
+    ready() is called once the worker accepts connections. On SIGTERM the
+    worker stops accepting and exits once its fetches are done or
+    drain_timeout seconds have passed.
+    """
+    ap = make_app(ctx)
+    server = HTTPServer(ap)
+    server.add_sockets(bind_sockets(port, reuse_port=True))
+    start_worker(worker, ctx)
+    admin = start_admin(worker, ctx)
+
+    io_loop = IOLoop.current()
+
+    def drain():
+        logging.info('worker %d draining', worker)
+        server.stop()
+        if admin is not None:
+            admin.stop()  # the replacement answers for this worker now
+        if ctx.refresher is not None:
+            ctx.refresher.stop()
+        deadline = time.time() + drain_timeout
+
+        def check():
+            if fetches_in_flight() and time.time() < deadline:
+                io_loop.call_later(DRAIN_POLL, check)
+                return
+            logging.info('worker %d stopped (%d fetches left)', worker,
+                         fetches_in_flight())
+            io_loop.stop()
+        check()
+
+    def on_term(signum, frame):
+        io_loop.add_callback_from_signal(drain)
+
+    signal.signal(signal.SIGTERM, on_term)
+    ready()
+    io_loop.start()
+    ctx.stop()
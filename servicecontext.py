@@ -0,0 +1,83 @@
+"""
+What a worker resolves urls with
+
+ServiceContext holds the lists, the fetch settings and the optional services
+(caches, admission control, fetch budget, fair queue, request log, crawl
+trace recording, debug capture) so that they are handed around as one
+object. Services that are off are None. canonicalservice.build_context()
+makes one from the configuration.
+"""
+
+from canonicalurl import REQ_TIMEOUT, MAX_READ
+
+
+MAX_CLIENTS = 100
+MAX_BATCH = 1000
+
+
+class ServiceContext(object):
+    """Lists, fetch settings and services of a worker
+    Args:
+        whitelist, expandlist - domain lists (see domainlists)
+        extract - the public suffix extractor
+        timeout - seconds per fetch
+        maxsize - most body bytes kept per page
+        maxclients - concurrent fetches per worker
+        maxbatch - most urls in one POST /batch
+        adminport - first per-worker debug port (None: no debug endpoints)
+        cache - CanonicalCache of results
+        refresher - RefreshAhead of hot cache entries
+        admission - AdmissionController that may shed fetches
+        request_log - RequestLog
+        budget - SharedFetchBudget of the whole instance
+        slow - SlowRequests capture (debug endpoints on)
+        features - PageFeatureCache of extraction results by page content
+        fetch_queue - FairQueue of the worker's fetches
+        recorder - TraceRecorder archiving every fetched hop
+        http_client - client fetches are made with instead of
+                      AsyncHTTPClient (a crawltrace.ReplayHTTPClient)
+
+    Services that are shared between workers must be created before
+    forking, the threads of the request log and the recorder are started in
+    each worker by start().
+    """
+    def __init__(self, whitelist, expandlist, extract, timeout=REQ_TIMEOUT,
+                 maxsize=MAX_READ, maxclients=MAX_CLIENTS,
+                 maxbatch=MAX_BATCH, adminport=None, cache=None,
+                 refresher=None, admission=None, request_log=None,
+                 budget=None, slow=None, features=None, fetch_queue=None,
+                 recorder=None, http_client=None):
+        self.whitelist = whitelist
+        self.expandlist = expandlist
+        self.extract = extract
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self.maxclients = maxclients
+        self.maxbatch = maxbatch
+        self.adminport = adminport
+        self.cache = cache
+        self.refresher = refresher
+        self.admission = admission
+        self.request_log = request_log
+        self.budget = budget
+        self.slow = slow
+        self.features = features
+        self.fetch_queue = fetch_queue
+        self.recorder = recorder
+        self.http_client = http_client
+
+    def start(self, worker):
+        """Starts the log and trace writer threads (after forking)
+        """
+        if self.request_log is not None:
+            self.request_log.start(worker)
+        if self.recorder is not None:
+            self.recorder.start(worker)
+
+    def stop(self):
+        """Stops the writer threads once they have written everything
+        """
+        if self.request_log is not None:
+            self.request_log.stop()
+        if self.recorder is not None:
+            self.recorder.stop()
@@ -0,0 +1,47 @@
+"""
+Process shared lock that is released when its holder dies
+
+multiprocessing.Lock is a semaphore: a worker killed (SIGKILL, crash) while
+holding it leaves it taken, and every other worker blocks on it forever.
+fcntl record locks are dropped by the kernel when their process exits.
+"""
+
+import fcntl
+import tempfile
+import threading
+
+
+class SharedLock(object):
+    """Exclusive lock across processes, and across the threads of each
+    Args:
+        path - lock file, for processes that do not share a parent;
+               None: an anonymous file (create the lock before forking)
+    """
+    def __init__(self, path=None):
+        if path is None:
+            self.file = tempfile.TemporaryFile()
+        else:
+            self.file = open(path, 'a+b')
+        # record locks are per process, threads need their own lock
+        self.thread_lock = threading.Lock()
+
+    def acquire(self):
+        self.thread_lock.acquire()
+        try:
+            fcntl.lockf(self.file.fileno(), fcntl.LOCK_EX)
+        except Exception:
+            self.thread_lock.release()
+            raise
+
+    def release(self):
+        try:
+            fcntl.lockf(self.file.fileno(), fcntl.LOCK_UN)
+        finally:
+            self.thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
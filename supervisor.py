@@ -0,0 +1,212 @@
+"""
+Supervisor for SO_REUSEPORT workers
+
+Forks a configurable number of workers, each listening on its own
+SO_REUSEPORT socket so the kernel spreads connections across them, and
+optionally pins each one to a CPU. Dead workers are replaced.
+
+SIGHUP restarts the workers one at a time: a replacement is started and
+accepting before the old worker is told to drain, so capacity never drops
+to zero. SIGTERM/SIGINT drain all workers and exit.
+"""
+
+import os
+import time
+import errno
+import ctypes
+import ctypes.util
+import select
+import signal
+import logging
+import multiprocessing
+from gracefulinterrupthandler import GracefulInterruptHandler
+
+
+POLL_INTERVAL = 0.5
+READY_TIMEOUT = 30
+RESPAWN_DELAY = 1  # seconds, avoids tight loops of crashing workers
+
+
+def set_cpu_affinity(cpu):
+    """Pins the calling process to one CPU (Linux)
+    """
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, set([cpu]))
+        return
+
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    mask = (ctypes.c_ulong * 16)()  # up to 1024 CPUs
+    bits = ctypes.sizeof(ctypes.c_ulong) * 8
+    mask[cpu // bits] = 1 << (cpu % bits)
+    if libc.sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)):
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+class Supervisor(object):
+    """Forks and supervises workers
+    Args:
+        run_worker - run_worker(worker, ready) serves until the worker should
+                     exit; ready() must be called once it accepts connections
+        workers - number of workers (0: one per CPU)
+        pin - pin worker i to CPU i (modulo the number of CPUs)
+        drain_timeout - seconds a worker gets to finish in-flight fetches
+        on_exit - on_exit(pid) is called for every worker that exited, to
+                  reclaim what it held in shared state
+    """
+    def __init__(self, run_worker, workers=0, pin=False, drain_timeout=30,
+                 on_exit=None):
+        self.run_worker = run_worker
+        self.on_exit = on_exit
+        self.cpus = multiprocessing.cpu_count()
+        self.workers = workers or self.cpus
+        self.pin = pin
+        self.drain_timeout = drain_timeout
+        self.children = {}  # pid -> worker
+        self.retiring = set()
+
+    def spawn(self, worker):
+        """Forks a worker and waits until it accepts connections
+        """
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(rfd)
+            code = 0
+            try:
+                # the supervisor decides when workers stop
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                if self.pin:
+                    set_cpu_affinity(worker % self.cpus)
+
+                def ready():
+                    os.write(wfd, b'1')
+                    os.close(wfd)
+
+                self.run_worker(worker, ready)
+            except Exception as ex:
+                logging.exception(ex)
+                code = 1
+            finally:
+                logging.shutdown()
+                os._exit(code)
+
+        os.close(wfd)
+        self.children[pid] = worker
+        try:
+            readable = select.select([rfd], [], [], READY_TIMEOUT)[0]
+            if not readable or not os.read(rfd, 1):
+                logging.warning('worker %d (%d) did not start', worker, pid)
+        except select.error:
+            pass  # interrupted by a signal
+        finally:
+            os.close(rfd)
+        logging.info('started worker %d (%d)', worker, pid)
+        return pid
+
+    def reap(self, block=False):
+        """Collects exited workers, returns {pid: worker} of those
+        """
+        exited = {}
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, 0 if block else os.WNOHANG)
+            except OSError as ex:
+                if ex.errno == errno.EINTR:
+                    continue
+                break
+            if pid == 0:
+                break
+            worker = self.children.pop(pid, None)
+            if worker is not None:
+                exited[pid] = worker
+                if self.on_exit is not None:
+                    try:
+                        self.on_exit(pid)
+                    except Exception as ex:
+                        logging.exception(ex)
+            if block:
+                break
+        return exited
+
+    def signal_stop(self, pid):
+        """Asks a worker to drain and exit
+        """
+        self.retiring.add(pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    def wait_worker(self, pid):
+        """Waits for a draining worker to exit, kills it if it takes too long
+        """
+        deadline = time.time() + self.drain_timeout + 5
+        while pid in self.children and time.time() < deadline:
+            self.respawn(self.reap())
+            time.sleep(0.1)
+
+        if pid in self.children:
+            logging.warning('killing worker %d', pid)
+            os.kill(pid, signal.SIGKILL)
+            while pid in self.children:
+                self.reap(block=True)
+
+    def respawn(self, exited):
+        """Replaces workers that died without being asked to
+        """
+        for pid, worker in exited.items():
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+                continue
+            logging.warning('worker %d (%d) died, restarting', worker, pid)
+            time.sleep(RESPAWN_DELAY)
+            self.spawn(worker)
+
+    def rolling_restart(self):
+        """Replaces workers one at a time
+        """
+        logging.info('rolling restart of %d workers', len(self.children))
+        for pid, worker in sorted(self.children.items(), key=lambda x: x[1]):
+            if pid not in self.children:
+                continue
+            self.spawn(worker)
+            self.signal_stop(pid)
+            self.wait_worker(pid)
+
+    def shutdown(self):
+        """Drains all workers at once
+        """
+        logging.info('shutting down %d workers', len(self.children))
+        pids = list(self.children)
+        for pid in pids:
+            self.signal_stop(pid)
+        for pid in pids:
+            self.wait_worker(pid)
+
+    def run(self):
+        """Starts the workers and supervises them until SIGTERM/SIGINT
+        """
+        for worker in xrange(self.workers):
+            self.spawn(worker)
+
+        # a SIGHUP arriving between handlers must not kill the supervisor
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        while True:
+            with GracefulInterruptHandler(signal.SIGTERM) as term, \
+                    GracefulInterruptHandler(signal.SIGINT) as intr, \
+                    GracefulInterruptHandler(signal.SIGHUP) as hup:
+                while not (term.interrupted or intr.interrupted or
+                           hup.interrupted):
+                    self.respawn(self.reap())
+                    time.sleep(POLL_INTERVAL)
+
+                if not (term.interrupted or intr.interrupted):
+                    self.rolling_restart()
+
+                if term.interrupted or intr.interrupted:
+                    self.shutdown()
+                    return
@@ -0,0 +1,30 @@
+import unittest
+from canonicalclient import INVALID_URL, SyncCanonicalClient, is_sendable
+
+
+class IsSendableTest(unittest.TestCase):
+    def test_urls(self):
+        self.assertTrue(is_sendable('http://a.com/x'))
+        self.assertTrue(is_sendable(u'http://a.com/\u2028'))
+        self.assertTrue(is_sendable('http://a.com/\r\n'))
+
+    def test_blank_or_several_lines(self):
+        for url in [None, '', ' ', '\t\n', 'http://a.com/\nhttp://b.com/',
+                    'http://a.com/\rhttp://b.com/']:
+            self.assertFalse(is_sendable(url), repr(url))
+
+
+class BlankUrlTest(unittest.TestCase):
+    def test_answered_without_the_service(self):
+        # nothing listens on the endpoint: only a batch would fail
+        client = SyncCanonicalClient(['http://127.0.0.1:9'], retries=0,
+                                     cache_size=0)
+        try:
+            results = client.resolve_many(['', '  ', 'a\nb'])
+            stats = client.stats()
+        finally:
+            client.close()
+        self.assertEqual([r['reason'] for r in results], [INVALID_URL] * 3)
+        self.assertEqual([r['url_original'] for r in results],
+                         ['', '  ', 'a\nb'])
+        self.assertNotIn('batches', stats)
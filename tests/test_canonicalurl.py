@@ -0,0 +1,47 @@
+import unittest
+from admission import AdmissionController, OVERLOADED
+from canonicalcache import CanonicalCache
+from canonicalurl import get_canonical_url_async
+from domainlists import get_extractor
+from fairqueue import FairQueue
+from servicecontext import ServiceContext
+
+
+class LocalAnswersTest(unittest.TestCase):
+    """Answers given without a fetch"""
+    def setUp(self):
+        self.ctx = ServiceContext(set(['a.com']), set(['bit.ly']),
+                                  get_extractor())
+        self.results = []
+
+    def resolve(self, url, **kwargs):
+        get_canonical_url_async(url, self.ctx, self.results.append, **kwargs)
+        self.assertEqual(len(self.results), 1)
+        return self.results.pop()
+
+    def test_invalid_url(self):
+        self.assertEqual(self.resolve('not a url')['reason'], 'invalid url')
+
+    def test_not_in_lists(self):
+        self.assertEqual(self.resolve('http://c.com/x')['reason'],
+                         'not in lists')
+
+    def test_cache_hit(self):
+        self.ctx.cache = CanonicalCache(size=10, ttl=60)
+        result = {'url_original': 'http://a.com/x',
+                  'url_retrieved': 'http://a.com/c',
+                  'method': 'canonical',
+                  'reason': 'canonical'}
+        self.ctx.cache.put('http://a.com/x', result, {})
+        trace = {}
+        self.assertEqual(self.resolve('http://a.com/x', trace=trace), result)
+        self.assertEqual(trace['cache'], 'hit')
+
+    def test_shed_by_class(self):
+        self.ctx.admission = AdmissionController(maxinflight=1, maxwait=0)
+        self.ctx.fetch_queue = FairQueue(0)  # nothing ever starts
+        self.ctx.fetch_queue.submit(lambda: None, 'bulk', 'c')
+        self.assertEqual(self.resolve('http://a.com/x',
+                                      priority='bulk')['reason'],
+                         OVERLOADED)
+        self.assertEqual(self.ctx.admission.stats()['shed'], 1)
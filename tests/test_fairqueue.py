@@ -0,0 +1,118 @@
+import unittest
+from collections import OrderedDict
+from admission import AdmissionController
+from fairqueue import FairQueue, parse_pairs
+from fetchbudget import SharedFetchBudget
+
+
+CLASS_OF = {'first': 'bulk', 'bulk': 'bulk', 'interactive': 'interactive'}
+
+
+def classes():
+    return OrderedDict([('interactive', 8.0), ('bulk', 1.0)])
+
+
+class FairQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.started = []
+
+    def submit(self, queue, name, priority, caller='c', host=None):
+        queue.submit(lambda: self.started.append(name), priority, caller,
+                     host)
+
+    def test_parse_pairs(self):
+        self.assertEqual(parse_pairs('a:1, b : 2,', float),
+                         OrderedDict([('a', 1.0), ('b', 2.0)]))
+
+    def test_classify(self):
+        queue = FairQueue(2, classes(), default='bulk',
+                          keys={'k1': 'interactive'})
+        self.assertEqual(queue.classify({'X-API-Key': 'k1'}, '10.0.0.1'),
+                         ('interactive', 'key:k1'))
+        self.assertEqual(queue.classify({'X-Priority': 'interactive'},
+                                        '10.0.0.1'),
+                         ('interactive', '10.0.0.1'))
+        self.assertEqual(queue.classify({}, '10.0.0.1'),
+                         ('bulk', '10.0.0.1'))
+        # an unknown key is no identity of its own
+        self.assertEqual(queue.classify({'X-API-Key': 'made-up'},
+                                        '10.0.0.1'),
+                         ('bulk', '10.0.0.1'))
+
+    def test_weights(self):
+        queue = FairQueue(1, classes())
+        self.submit(queue, 'first', 'bulk')
+        for i in range(9):
+            self.submit(queue, 'bulk', 'bulk')
+            self.submit(queue, 'interactive', 'interactive')
+        for i in range(18):
+            queue.release(CLASS_OF[self.started[-1]], 'c')
+        self.assertEqual(len(self.started), 19)
+        # 8 interactive fetches for every bulk one
+        self.assertEqual(self.started[1:9], ['interactive'] * 8)
+        self.assertEqual(queue.stats()['active'], 1)
+
+    def test_caller_quota(self):
+        queue = FairQueue(4, classes(), quota=1)
+        self.submit(queue, 'a1', 'bulk', 'a')
+        self.submit(queue, 'a2', 'bulk', 'a')
+        self.submit(queue, 'b1', 'bulk', 'b')
+        self.assertEqual(self.started, ['a1', 'b1'])
+        queue.release('bulk', 'a')
+        self.assertEqual(self.started, ['a1', 'b1', 'a2'])
+
+    def test_no_caller(self):
+        queue = FairQueue(10, classes())
+        queue.submit(lambda: self.started.append('anonymous'))
+        self.submit(queue, 'c', None)
+        self.assertEqual(self.started, ['anonymous', 'c'])
+        self.assertEqual(queue.over_quota, 0)
+        queue.release()
+        self.assertEqual(queue.stats()['active'], 1)
+
+    def test_load_ignores_lighter_classes(self):
+        queue = FairQueue(2, classes())
+        for i in range(10):
+            self.submit(queue, 'bulk', 'bulk')
+        self.submit(queue, 'interactive', 'interactive')
+        self.assertEqual(queue.load('bulk')[0], 11)
+        self.assertEqual(queue.load('interactive')[0], 1)
+        self.assertGreaterEqual(queue.load('bulk')[1], 0.0)
+
+        admission = AdmissionController(maxinflight=5, maxwait=0)
+        self.assertFalse(admission.admit(queue, 'bulk'))
+        self.assertTrue(admission.admit(queue, 'interactive'))
+
+    def test_release_handler(self):
+        queue = FairQueue(1, classes())
+        self.submit(queue, 'a', 'bulk')
+        self.submit(queue, 'b', 'bulk')
+        responses = []
+        queue.make_release_handler('bulk', 'c', responses.append)('r')
+        self.assertEqual(responses, ['r'])
+        self.assertEqual(self.started, ['a', 'b'])
+        self.assertEqual(queue.stats()['classes']['bulk']['dispatched'], 2)
+
+    def test_budget_slot_before_start(self):
+        budget = SharedFetchBudget(maxclients=1, perhost=1)
+        queue = FairQueue(10, classes(), budget=budget)
+        self.submit(queue, 'first', 'bulk', host='a.com')
+        self.submit(queue, 'bulk', 'bulk', host='b.com')
+        self.submit(queue, 'interactive', 'interactive', host='c.com')
+        # waiting for the budget is waiting in the queue, in class order
+        self.assertEqual(self.started, ['first'])
+        self.assertEqual(queue.stats()['active'], 1)
+        queue.release('bulk', 'c', 'a.com')
+        self.assertEqual(self.started, ['first', 'interactive'])
+        self.assertEqual(budget.stats()['in_flight'], 1)
+        self.assertEqual(len(queue.classes['interactive'].waits), 1)
+
+    def test_busy_host_lets_others_start(self):
+        budget = SharedFetchBudget(maxclients=10, perhost=1)
+        queue = FairQueue(10, classes(), budget=budget)
+        self.submit(queue, 'a1', 'bulk', host='a.com')
+        self.submit(queue, 'a2', 'interactive', host='a.com')
+        self.submit(queue, 'b1', 'bulk', host='b.com')
+        self.assertEqual(self.started, ['a1', 'b1'])
+        queue.release('bulk', 'c', 'a.com')
+        self.assertEqual(self.started, ['a1', 'b1', 'a2'])
@@ -0,0 +1,80 @@
+import os
+import signal
+import unittest
+from fetchbudget import (SharedFetchBudget, refill, DENIED_GLOBAL,
+                         DENIED_HOST)
+
+
+def in_child(function):
+    """Runs function in a forked child, returns once it exited
+    """
+    pid = os.fork()
+    if pid == 0:
+        try:
+            function()
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    return pid
+
+
+class FetchBudgetTest(unittest.TestCase):
+    def setUp(self):
+        # a lock that is never released must fail the test, not hang it
+        signal.alarm(10)
+
+    def tearDown(self):
+        signal.alarm(0)
+
+    def test_limits(self):
+        budget = SharedFetchBudget(maxclients=2, perhost=1)
+        self.assertIsNone(budget.try_acquire('a.com'))
+        self.assertEqual(budget.try_acquire('a.com'), DENIED_HOST)
+        self.assertIsNone(budget.try_acquire('b.com'))
+        self.assertEqual(budget.try_acquire('c.com'), DENIED_GLOBAL)
+        budget.release('a.com')
+        self.assertIsNone(budget.try_acquire('a.com'))
+        self.assertEqual(budget.stats()['in_flight'], 2)
+
+    def test_slow_rates(self):
+        budget = SharedFetchBudget(maxclients=0, perhost=0, hostrate=0.5)
+        self.assertIsNone(budget.try_acquire('a.com'))
+        self.assertEqual(budget.try_acquire('a.com'), DENIED_HOST)
+        # half a token a second: a whole one after two seconds
+        self.assertLess(refill(0.0, 0.0, 1.1, 0.5), 1)
+        self.assertEqual(refill(0.0, 0.0, 2.0, 0.5), 1)
+        self.assertEqual(refill(0.0, 0.0, 60.0, 0.5), 1)
+        self.assertEqual(refill(0.0, 0.0, 60.0, 10.0), 10)
+
+    def test_reclaim_exited_worker(self):
+        budget = SharedFetchBudget(maxclients=10, perhost=2)
+        budget.try_acquire('b.com')
+        pid = in_child(lambda: (budget.try_acquire('a.com'),
+                                budget.try_acquire('a.com')))
+        self.assertEqual(budget.stats()['in_flight'], 3)
+        self.assertEqual(budget.reclaim(pid), 2)
+        stats = budget.stats()
+        self.assertEqual(stats['in_flight'], 1)
+        self.assertEqual(stats['busy_hosts'], 1)
+        self.assertEqual(budget.try_acquire('a.com'), None)
+        self.assertEqual(budget.try_acquire('a.com'), None)
+
+    def test_dead_worker_swept_by_new_worker(self):
+        budget = SharedFetchBudget(maxclients=1, perhost=1)
+        in_child(lambda: budget.try_acquire('a.com'))
+        # the parent registers now and finds the child's pid dead
+        self.assertIsNone(budget.try_acquire('a.com'))
+        self.assertEqual(budget.stats()['in_flight'], 1)
+
+    def test_killed_while_holding_lock(self):
+        budget = SharedFetchBudget()
+
+        def die_locked():
+            budget.lock.acquire()
+            os.kill(os.getpid(), signal.SIGKILL)
+        in_child(die_locked)
+        self.assertIsNone(budget.try_acquire('a.com'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import os
+import shutil
+import tempfile
+import unittest
+from pagecache import (PageFeatureCache, HEADER, SLOT, content_key,
+                       get_domain)
+
+
+class ContentKeyTest(unittest.TestCase):
+    def test_encoding_is_part_of_the_key(self):
+        page = b'<html><head></head></html>'
+        self.assertEqual(content_key(page, 'utf-8'),
+                         content_key(bytearray(page), 'utf-8'))
+        self.assertNotEqual(content_key(page, 'utf-8'),
+                            content_key(page, 'latin-1'))
+        self.assertEqual(content_key(page, None)[1], len(page))
+
+    def test_get_domain(self):
+        self.assertEqual(get_domain('http://www.A.com:80/x'), 'a.com')
+        self.assertEqual(get_domain('not a url'), '')
+
+
+class PageFeatureCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'pages')
+        self.key = content_key(b'<html>page</html>', 'utf-8')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_put_get(self):
+        features = PageFeatureCache(slots=16)
+        self.assertIsNone(features.get(self.key, 'http://a.com/'))
+        features.put(self.key, 'canonical', u'http://a.com/c')
+        self.assertEqual(features.get(self.key, 'http://a.com/x'),
+                         ('canonical', u'http://a.com/c'))
+        features.put(self.key, 'no attributes')
+        self.assertEqual(features.get(self.key), ('no attributes', None))
+        # same hash, other length: another page
+        self.assertIsNone(features.get((self.key[0], self.key[1] + 1)))
+
+        stats = features.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 2))
+        self.assertEqual(stats['domains']['a.com']['hit_rate'], 0.5)
+
+    def test_not_stored(self):
+        features = PageFeatureCache(slots=16)
+        features.put(self.key, 'unreachable-or-unknown')
+        features.put(self.key, 'canonical', u'http://a.com/' + u'x' * 1000)
+        self.assertIsNone(features.get(self.key))
+
+    def test_file_survives_reopening(self):
+        PageFeatureCache(slots=16, path=self.path, version=3).put(
+            self.key, 'canonical', u'http://a.com/c')
+        self.assertTrue(os.path.exists(self.path + '.lock'))
+        features = PageFeatureCache(slots=16, path=self.path, version=3)
+        self.assertEqual(features.get(self.key),
+                         ('canonical', u'http://a.com/c'))
+
+    def test_other_version_or_size_is_replaced(self):
+        old = PageFeatureCache(slots=16, path=self.path, version=3)
+        old.put(self.key, 'canonical', u'http://a.com/c')
+        features = PageFeatureCache(slots=16, path=self.path, version=4)
+        self.assertIsNone(features.get(self.key))
+        self.assertEqual(HEADER.unpack_from(features.table, 0)[1], 4)
+        # a process still using the old file is not disturbed
+        self.assertEqual(old.get(self.key), ('canonical', u'http://a.com/c'))
+
+        features.put(self.key, 'canonical', u'http://a.com/c')
+        features = PageFeatureCache(slots=32, path=self.path, version=4)
+        self.assertIsNone(features.get(self.key))
+        self.assertEqual(sorted(os.listdir(self.dir)),
+                         ['pages', 'pages.lock'])
+
+    def test_torn_slot_is_a_miss(self):
+        features = PageFeatureCache(slots=16)
+        features.put(self.key, 'canonical', u'http://a.com/c')
+        # a writer killed between the slot header and the url bytes
+        start = features.slot_offset(self.key[0]) + SLOT.size
+        features.table[start:start + 3] = b'xyz'
+        self.assertIsNone(features.get(self.key))
+
+    def test_shared_with_other_processes(self):
+        features = PageFeatureCache(slots=16, path=self.path)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                # an unrelated process opening the same file
+                PageFeatureCache(slots=16, path=self.path).put(
+                    self.key, 'canonical', u'http://a.com/c')
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(features.get(self.key),
+                         ('canonical', u'http://a.com/c'))
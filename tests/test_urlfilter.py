@@ -0,0 +1,56 @@
+import unittest
+from domainlists import get_extractor
+from urlfilter import HostFilter, build_index, get_host
+
+
+class GetHostTest(unittest.TestCase):
+    def test_strips_scheme_credentials_and_port(self):
+        self.assertEqual(get_host('http://user:pw@WWW.Example.com:8080/a?b'),
+                         'www.example.com')
+
+    def test_bare_host(self):
+        self.assertEqual(get_host('example.com/path'), 'example.com')
+
+
+class HostFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.extract = get_extractor()
+
+    def test_mask(self):
+        host_filter = HostFilter(build_index(['a.com', 'b.co.uk']),
+                                 self.extract)
+        urls = ['http://a.com/x', 'http://www.b.co.uk/', 'http://c.com/',
+                'https://sub.a.com/y']
+        self.assertEqual(list(host_filter.mask(urls)), [1, 1, 0, 1])
+        self.assertEqual(list(host_filter.filter(urls)),
+                         ['http://a.com/x', 'http://www.b.co.uk/',
+                          'https://sub.a.com/y'])
+
+    def test_hosts_resolved_once(self):
+        host_filter = HostFilter(build_index(['a.com']), self.extract)
+        host_filter.mask(['http://a.com/1', 'http://a.com/2'])
+        host_filter.mask(['http://a.com/3'])
+        self.assertEqual(host_filter.resolved, 1)
+
+    def test_overflow_keeps_current_batch(self):
+        host_filter = HostFilter(build_index(['a.com']), self.extract,
+                                 maxhosts=2)
+        self.assertEqual(
+            list(host_filter.mask_batch(['http://a.com/x', 'http://b.com/'])),
+            [1, 0])
+        self.assertEqual(
+            list(host_filter.mask_batch(['http://a.com/y', 'http://c.com/'])),
+            [1, 0])
+        self.assertEqual(set(host_filter.hosts), set(['a.com', 'c.com']))
+
+    def test_overflow_across_batches(self):
+        host_filter = HostFilter(build_index(['a.com']), self.extract,
+                                 maxhosts=3)
+        urls = ['http://h{}.com/'.format(i % 7) for i in range(50)]
+        urls += ['http://a.com/']
+        mask = host_filter.mask(urls, batch_size=4)
+        self.assertEqual(list(mask), [0] * 50 + [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
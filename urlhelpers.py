@@ -71,8 +71,7 @@ def url_or_error(url):
 
     # Validate URL
     if not validate_url(url):
-        msg = 'bad url: {} '.format(url)
-        logging.error(msg)
+        logging.error('bad url: %s ', url)
         return None
 
     return url